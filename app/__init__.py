@@ -14,13 +14,14 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 
 from config import Config
 
+from .replicas import RoutingSQLAlchemy
+
 
 # Plugin initialization
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 babel = Babel()
 bootstrap = Bootstrap()
@@ -29,6 +30,8 @@ moment = Moment()
 mail = Mail()
 
 login.login_view = "auth.login"
+# API requests that need a login get a 401 instead of a redirect to the login page
+login.blueprint_login_views = {"api": None}
 login.login_message = _l("Please log in to access this page.")
 
 
@@ -54,6 +57,35 @@ def create_app(config_class: Config = Config) -> Flask:
     mail.init_app(app)
     moment.init_app(app)
 
+    from .replicas import router as replica_router
+
+    replica_router.init_app(app)
+
+    from .email import dispatcher as email_dispatcher
+
+    email_dispatcher.init_app(app)
+
+    from .fragments import cache as fragment_cache
+
+    fragment_cache.init_app(app)
+
+    from .language import detector as language_detector
+
+    language_detector.init_app(app)
+
+    from .last_seen import tracker as last_seen_tracker
+
+    last_seen_tracker.init_app(app)
+
+    from .translate import cache as translation_cache, TranslatorClient
+
+    app.translator: Optional[TranslatorClient] = TranslatorClient.from_config(app.config)
+    translation_cache.init_app(app)
+
+    from . import instrumentation
+
+    instrumentation.init_app(app)
+
     # Register Elasticsearch as an instance attribute
     app.elasticsearch: Optional[Elasticsearch] = (
         Elasticsearch([app.config["ELASTICSEARCH_URL"]])
@@ -61,11 +93,19 @@ def create_app(config_class: Config = Config) -> Flask:
         else None
     )
 
+    from .indexer import indexer as search_indexer
+    from .search import create_backend, SearchBackend
+
+    app.search_backend: Optional[SearchBackend] = create_backend(app)
+    search_indexer.init_app(app)
+
     # Register blueprints
+    from .api import bp as api_bp
     from .auth import bp as auth_bp
     from .errors import bp as errors_bp
     from .main import bp as main_bp
 
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
     app.register_blueprint(auth_bp, url_prefix="/auth")
     app.register_blueprint(errors_bp)
     app.register_blueprint(main_bp)
@@ -99,6 +139,7 @@ def create_app(config_class: Config = Config) -> Flask:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.INFO)
             app.logger.addHandler(stream_handler)
+            instrumentation.slow_query_logger.addHandler(stream_handler)
         else:
             if not os.path.exists("logs"):
                 os.mkdir("logs")
@@ -111,6 +152,12 @@ def create_app(config_class: Config = Config) -> Flask:
             file_handler.setLevel(logging.INFO)
             app.logger.addHandler(file_handler)
 
+            slow_query_handler = RotatingFileHandler(
+                "logs/slow_queries.log", maxBytes=1048576, backupCount=10
+            )
+            slow_query_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            instrumentation.slow_query_logger.addHandler(slow_query_handler)
+
         app.logger.setLevel(logging.INFO)
         app.logger.info("Microblog startup")
 
@@ -0,0 +1,9 @@
+"""
+app/api/__init__.py
+"""
+from flask import Blueprint
+
+
+bp = Blueprint("api", __name__)
+
+from . import errors, routes  # noqa: E402,F401
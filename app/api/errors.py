@@ -0,0 +1,22 @@
+"""
+app/api/errors.py
+"""
+from werkzeug.exceptions import HTTPException
+
+from app import db
+
+from . import bp
+from .serializers import json_response
+
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    """Reports HTTP errors raised by API views as JSON instead of HTML pages"""
+    return json_response({"error": error.name, "message": error.description}, error.code)
+
+
+@bp.errorhandler(500)
+def internal_error(error):
+    """Rolls back database session and reports the error as JSON"""
+    db.session.rollback()
+    return json_response({"error": "Internal Server Error"}, 500)
@@ -0,0 +1,144 @@
+"""
+app/api/routes.py
+"""
+from typing import Optional, Tuple
+
+from flask import abort, current_app, request, url_for
+from flask_login import current_user, login_required
+from flask_sqlalchemy import BaseQuery
+
+from app import db
+from app.last_seen import tracker as last_seen_tracker
+from app.models import Post, User
+from app.pagination import decode_cursor, decode_sort_values, keyset_paginate
+
+from . import bp
+from .serializers import (
+    json_response,
+    page,
+    post_to_dict,
+    POST_COLUMNS,
+    user_to_dict,
+    USER_COLUMNS,
+)
+
+
+@bp.before_request
+def before_request():
+    """Records the user's activity, like the HTML views do"""
+    if current_user.is_authenticated:
+        last_seen_tracker.record(current_user)
+
+
+def _per_page() -> int:
+    """Page size from the `limit` argument, between 1 and API_MAX_PER_PAGE"""
+    limit = request.args.get("limit", current_app.config["POSTS_PER_PAGE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PER_PAGE"]))
+
+
+def _post_page(query: BaseQuery, keys: Optional[Tuple] = None, **view_args):
+    """Serializes one keyset page of a listing of posts, selecting only the columns needed"""
+    view_args["limit"] = request.args.get("limit")
+    posts = keyset_paginate(
+        query.join(User, User.id == Post.user_id).with_entities(*POST_COLUMNS),
+        _per_page(),
+        before=request.args.get("before", type=decode_cursor),
+        after=request.args.get("after", type=decode_cursor),
+        keys=keys,
+    )
+    next_url = url_for(
+        request.endpoint, before=posts.next_cursor, **view_args
+    ) if posts.has_next else None
+    prev_url = url_for(
+        request.endpoint, after=posts.prev_cursor, **view_args
+    ) if posts.has_prev else None
+    return json_response(page([post_to_dict(row) for row in posts.items], next_url, prev_url))
+
+
+@bp.route("/timeline")
+@login_required
+def timeline():
+    """Posts by the user and the users they follow, newest first"""
+    return _post_page(current_user.followed_posts(), keys=current_user.followed_posts_keys())
+
+
+@bp.route("/explore")
+@login_required
+def explore():
+    """Posts by all users, newest first"""
+    return _post_page(Post.query)
+
+
+@bp.route("/users/<username>")
+@login_required
+def user(username):
+    """A user's profile, with whether the current user follows them, from a single query"""
+    row = (
+        db.session.query(*USER_COLUMNS, User.followed_by(current_user))
+        .filter(User.username == username)
+        .first_or_404()
+    )
+    return json_response(user_to_dict(row, bool(row[-1])))
+
+
+@bp.route("/users/<username>/posts")
+@login_required
+def user_posts(username):
+    """Posts by a user, newest first"""
+    user_id = db.session.query(User.id).filter(User.username == username).scalar()
+    if user_id is None:
+        abort(404)
+    return _post_page(Post.query.filter(Post.user_id == user_id), username=username)
+
+
+@bp.route("/users/<username>/followers")
+@login_required
+def followers(username):
+    """A user's followers, most recently registered first. Paginated by seeking on the user id."""
+    user = User.query.filter(User.username == username).first_or_404()
+    per_page = _per_page()
+    before = request.args.get("before", type=int)
+    after = request.args.get("after", type=int)
+    query = user.followers.with_entities(*USER_COLUMNS).order_by(None)
+    if after is not None:
+        rows = query.filter(User.id > after).order_by(User.id.asc()).limit(per_page + 1).all()
+        has_next, has_prev = True, len(rows) > per_page
+        rows = rows[:per_page][::-1]
+    else:
+        if before is not None:
+            query = query.filter(User.id < before)
+        rows = query.order_by(User.id.desc()).limit(per_page + 1).all()
+        has_next, has_prev = len(rows) > per_page, before is not None
+        rows = rows[:per_page]
+    limit = request.args.get("limit")
+    next_url = url_for(
+        "api.followers", username=username, limit=limit, before=rows[-1].id
+    ) if has_next and rows else None
+    prev_url = url_for(
+        "api.followers", username=username, limit=limit, after=rows[0].id
+    ) if has_prev and rows else None
+    return json_response(page([user_to_dict(row) for row in rows], next_url, prev_url))
+
+
+@bp.route("/search")
+@login_required
+def search():
+    """Posts matching the `q` argument, most relevant first"""
+    q = request.args.get("q", "").strip()
+    if not q:
+        abort(400, "The q argument is required")
+    posts = Post.search(
+        q,
+        _per_page(),
+        before=request.args.get("before", type=decode_sort_values),
+        after=request.args.get("after", type=decode_sort_values),
+        query=Post.query.join(User, User.id == Post.user_id).with_entities(*POST_COLUMNS),
+    )
+    limit = request.args.get("limit")
+    next_url = url_for(
+        "api.search", q=q, limit=limit, before=posts.next_cursor
+    ) if posts.has_next else None
+    prev_url = url_for(
+        "api.search", q=q, limit=limit, after=posts.prev_cursor
+    ) if posts.has_prev else None
+    return json_response(page([post_to_dict(row) for row in posts.items], next_url, prev_url))
@@ -0,0 +1,86 @@
+"""
+app/api/serializers.py
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from flask import current_app, Response
+
+from app.models import gravatar_url, Post, User
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Columns the API reads instead of hydrating ORM objects
+POST_COLUMNS = (
+    Post.id,
+    Post.body,
+    Post.timestamp,
+    Post.language,
+    User.username.label("author_username"),
+    User.email.label("author_email"),
+)
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.email,
+    User.about_me,
+    User.last_seen,
+    User.follower_count,
+    User.following_count,
+)
+AVATAR_SIZE = 70
+
+
+def json_response(payload: Any, status: int = 200) -> Response:
+    """Serializes a payload of plain values with orjson when it is installed, and with compact
+    standard library JSON otherwise
+    """
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return current_app.response_class(body, status=status, mimetype="application/json")
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[str]:
+    return None if value is None else value.isoformat() + "Z"
+
+
+def post_to_dict(row: Any) -> Dict[str, Any]:
+    """Serializes a row of POST_COLUMNS"""
+    return {
+        "id": row.id,
+        "body": row.body,
+        "timestamp": _timestamp(row.timestamp),
+        "language": row.language or None,
+        "author": {
+            "username": row.author_username,
+            "avatar": gravatar_url(row.author_email, AVATAR_SIZE),
+        },
+    }
+
+
+def user_to_dict(row: Any, is_following: Optional[bool] = None) -> Dict[str, Any]:
+    """Serializes a row of USER_COLUMNS, with the viewer's following state if it is known"""
+    data = {
+        "id": row.id,
+        "username": row.username,
+        "avatar": gravatar_url(row.email, AVATAR_SIZE),
+        "about_me": row.about_me,
+        "last_seen": _timestamp(row.last_seen),
+        "follower_count": row.follower_count,
+        "following_count": row.following_count,
+    }
+    if is_following is not None:
+        data["is_following"] = is_following
+    return data
+
+
+def page(items: List[Dict[str, Any]], next_url: Optional[str], prev_url: Optional[str]) -> Dict:
+    """Wraps one page of serialized items with the URLs of the neighbouring pages"""
+    return {"items": items, "next": next_url, "prev": prev_url}
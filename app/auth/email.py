@@ -1,18 +1,22 @@
-from flask import current_app, render_template
-from flask_babel import _
+from flask import current_app, url_for
+from flask_babel import get_locale
 
-from app.email import send_email
+from app.email import N_, send_template_email
 from app.models import User
 
 
 def send_password_reset_email(user: User) -> None:
-    """Send a given user a password reset token"""
+    """Queue a password reset token for a given user. The email is rendered by the email
+    dispatcher, in the locale of the current request.
+    """
 
     token = user.get_reset_password_token()
-    send_email(
-        _("[Microblog] Reset Your Password"),
+    send_template_email(
+        N_("[Microblog] Reset Your Password"),
+        "reset_password",
+        [user.email],
+        str(get_locale()),
         sender=current_app.config["ADMINS"][0],
-        recipients=[user.email],
-        text_body=render_template("email/reset_password.txt.j2", user=user, token=token),
-        html_body=render_template("email/reset_password.html", user=user, token=token),
+        username=user.username,
+        reset_url=url_for("auth.reset_password", token=token, _external=True),
     )
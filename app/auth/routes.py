@@ -3,13 +3,14 @@ app/auth/routes.py
 """
 from typing import Optional
 
-from flask import flash, redirect, render_template, request, url_for
-from flask_babel import _
+from flask import current_app, flash, redirect, render_template, request, url_for
+from flask_babel import _, get_locale
 from flask_login import current_user, login_user, logout_user
 from sqlalchemy.exc import DBAPIError, SQLAlchemyError
 from werkzeug.urls import url_parse
 
 from app import db
+from app.email import EmailQueueFull
 from app.models import User
 
 from . import bp
@@ -32,6 +33,14 @@ def login():
             flash(_("Invalid username or password"))
             return redirect(url_for("auth.login"))
         login_user(user, remember=form.remember_me.data)
+        locale = str(get_locale())
+        if user.locale != locale:
+            user.locale = locale
+            try:
+                db.session.commit()
+            except (DBAPIError, SQLAlchemyError) as e:
+                db.session.rollback()
+                current_app.logger.error(e)
         next_page = request.args.get("next")
 
         # check for valid ?next query param and re-assign if necessary
@@ -60,7 +69,7 @@ def register():
 
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
+        user = User(username=form.username.data, email=form.email.data, locale=str(get_locale()))
         user.set_password(form.password.data)
 
         try:
@@ -85,7 +94,11 @@ def reset_password_request():
     if form.validate_on_submit():
         user: Optional[User] = User.query.filter_by(email=form.email.data).first()
         if user is not None:
-            send_password_reset_email(user)
+            try:
+                send_password_reset_email(user)
+            except EmailQueueFull as e:
+                # Answer as usual, so that the response does not reveal whether the user exists
+                current_app.logger.warning(f"Password reset email for {user.id} dropped: {e}")
         flash(_("Check your email for the instructions to reset your password"))
         return redirect(url_for("auth.login"))
     return render_template("auth/reset_password_request.html", title=_("Reset Password"), form=form)
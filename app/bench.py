@@ -0,0 +1,279 @@
+"""
+app/bench.py
+"""
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import cycle
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import requests
+from flask import current_app, Flask
+from werkzeug.security import generate_password_hash
+
+from . import db
+from .instrumentation import count_queries
+from .models import followers, Post, SearchableMixin, User
+
+CHUNK_SIZE = 10000
+PASSWORD = "bench"
+WORDS = (
+    "coffee morning travel music release weekend python flask database launch team photo city "
+    "train book movie garden winter summer deploy"
+).split()
+
+
+def seed(users: int, edges: int, posts: int, prefix: str = "bench", random_seed: int = 0) -> Dict:
+    """Bulk-inserts a synthetic social graph: users named `<prefix><n>`, a power-law follow graph
+    where a few accounts attract most of the follows, and posts written mostly by those accounts.
+    Timelines, follow counters and search indexes are then rebuilt in bulk, as the app would have
+    maintained them.
+
+    :param users: Number of users
+    :type users: int
+    :param edges: Number of follow relationships
+    :type edges: int
+    :param posts: Number of posts
+    :type posts: int
+    :param prefix: Username prefix, which must not be in use yet, defaults to "bench"
+    :type prefix: str
+    :param random_seed: Seed for the random generator, so runs are reproducible, defaults to 0
+    :type random_seed: int
+
+    :return: The seeded counts and the usernames of the most followed and most following users
+    :rtype: Dict
+    """
+    rng = random.Random(random_seed)
+    # Hashing is deliberately slow, so every seeded user shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+    with db.engine.begin() as connection:
+        for offset in range(0, users, CHUNK_SIZE):
+            connection.execute(
+                User.__table__.insert(),
+                [
+                    {
+                        "username": f"{prefix}{i}",
+                        "email": f"{prefix}{i}@example.com",
+                        "password_hash": password_hash,
+                    }
+                    for i in range(offset, min(offset + CHUNK_SIZE, users))
+                ],
+            )
+    ids = [
+        id for id, in db.session.query(User.id).filter(User.username.like(f"{prefix}%")).all()
+    ]
+
+    weights = [rng.paretovariate(1.2) for _ in ids]
+    seen = set()
+    batch: List[Dict[str, int]] = []
+    with db.engine.begin() as connection:
+        while len(seen) < edges:
+            follower = rng.choice(ids)
+            for followed in rng.choices(ids, weights, k=64):
+                if len(seen) >= edges:
+                    break
+                if followed != follower and (follower, followed) not in seen:
+                    seen.add((follower, followed))
+                    batch.append({"follower_id": follower, "followed_id": followed})
+            if batch and (len(batch) >= CHUNK_SIZE or len(seen) >= edges):
+                connection.execute(followers.insert(), batch)
+                batch = []
+
+    start = datetime.utcnow() - timedelta(days=365)
+    with db.engine.begin() as connection:
+        for offset in range(0, posts, CHUNK_SIZE):
+            connection.execute(
+                Post.__table__.insert(),
+                [
+                    {
+                        "body": " ".join(rng.choices(WORDS, k=8)),
+                        "timestamp": start + timedelta(seconds=rng.randint(0, 365 * 86400)),
+                        "language": "en",
+                        "user_id": rng.choices(ids, weights)[0],
+                    }
+                    for _ in range(offset, min(offset + CHUNK_SIZE, posts))
+                ],
+            )
+
+    User.reconcile_follow_counts()
+    User.rebuild_timelines()
+    db.session.commit()
+    if current_app.search_backend is not None:
+        for cls in SearchableMixin.__subclasses__():
+            cls.reindex()
+
+    bench_users = User.query.filter(User.username.like(f"{prefix}%"))
+    popular = bench_users.order_by(User.follower_count.desc()).first()
+    reader = bench_users.order_by(User.following_count.desc()).first()
+    return {
+        "users": len(ids),
+        "edges": len(seen),
+        "posts": posts,
+        "popular": popular.username if popular else None,
+        "reader": reader.username if reader else None,
+    }
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Returns the nearest-rank percentile of a list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+class _TestClientDriver:
+    """Sends requests through the Flask test client, in-process, counting SQL statements"""
+
+    def __init__(self, app: Flask):
+        self.client = app.test_client()
+
+    def login(self, username: str, password: str) -> bool:
+        response = self.client.post(
+            "/auth/login", data={"username": username, "password": password}
+        )
+        return response.status_code == 302
+
+    def get(self, path: str) -> Tuple[int, Optional[int]]:
+        with count_queries() as counter:
+            response = self.client.get(path)
+            response.close()
+        return response.status_code, counter.count
+
+
+class _HTTPDriver:
+    """Sends requests to a running server, e.g. a local gunicorn. Statements cannot be counted."""
+
+    csrf = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def login(self, username: str, password: str) -> bool:
+        page = self.session.get(f"{self.url}/auth/login")
+        token = self.csrf.search(page.text)
+        data = {"username": username, "password": password}
+        if token:
+            data["csrf_token"] = token.group(1)
+        response = self.session.post(f"{self.url}/auth/login", data=data, allow_redirects=False)
+        return response.status_code == 302
+
+    def get(self, path: str) -> Tuple[int, Optional[int]]:
+        response = self.session.get(f"{self.url}{path}", allow_redirects=False)
+        return response.status_code, None
+
+
+def routes(popular: str, term: str) -> Dict[str, Callable[[], Iterator[str]]]:
+    """Returns the benchmarked routes, as factories of the paths each worker requests in turn"""
+    return {
+        "index": lambda: cycle(["/index"]),
+        "explore": lambda: cycle(["/explore"]),
+        "user": lambda: cycle([f"/user/{popular}"]),
+        "popup": lambda: cycle([f"/user/{popular}/popup"]),
+        "search": lambda: cycle([f"/search?q={term}"]),
+        "api_timeline": lambda: cycle(["/api/v1/timeline"]),
+        "follow": lambda: cycle([f"/follow/{popular}", f"/unfollow/{popular}"]),
+    }
+
+
+def run(
+    names: Sequence[str],
+    requests_per_route: int,
+    concurrency: int,
+    warmup: int = 10,
+    url: Optional[str] = None,
+    prefix: str = "bench",
+    term: str = "coffee",
+) -> Dict[str, Any]:
+    """Requests each route `requests_per_route` times from `concurrency` workers, each logged in as
+    a different seeded user, and measures latency, throughput and SQL statements per request
+
+    :param names: Routes to benchmark, from `routes`
+    :type names: Sequence[str]
+    :param requests_per_route: Timed requests per route
+    :type requests_per_route: int
+    :param concurrency: Concurrent workers
+    :type concurrency: int
+    :param warmup: Untimed requests per worker and route, defaults to 10
+    :type warmup: int
+    :param url: Server to benchmark, defaults to the app itself through the test client
+    :type url: Optional[str]
+    :param prefix: Username prefix of the seeded users, defaults to "bench"
+    :type prefix: str
+    :param term: Search term, defaults to "coffee"
+    :type term: str
+
+    :return: Results per route, with latencies in milliseconds
+    :rtype: Dict[str, Any]
+    """
+    bench_users = User.query.filter(User.username.like(f"{prefix}%"))
+    popular = bench_users.order_by(User.follower_count.desc()).first()
+    readers = [
+        username
+        for username, in bench_users.with_entities(User.username)
+        .order_by(User.following_count.desc())
+        .limit(concurrency)
+    ]
+    if popular is None or len(readers) < concurrency:
+        raise ValueError(f"not enough {prefix} users, run `flask bench seed` first")
+    paths = routes(popular.username, term)
+    app = current_app._get_current_object()
+    if url is None:
+        # Login forms are posted by the benchmark itself
+        app.config["WTF_CSRF_ENABLED"] = False
+
+    drivers = []
+    for username in readers:
+        driver = _HTTPDriver(url) if url else _TestClientDriver(app)
+        if not driver.login(username, PASSWORD):
+            raise ValueError(f"could not log in as {username}")
+        drivers.append(driver)
+
+    results: Dict[str, Any] = {}
+    for name in names:
+        latencies: List[float] = []
+        queries: List[int] = []
+        errors = 0
+        lock = Lock()
+        counts = [requests_per_route // concurrency] * concurrency
+        for i in range(requests_per_route % concurrency):
+            counts[i] += 1
+
+        def work(driver, count: int) -> None:
+            nonlocal errors
+            route = paths[name]()
+            for _ in range(warmup):
+                driver.get(next(route))
+            for _ in range(count):
+                start = perf_counter()
+                status, statements = driver.get(next(route))
+                elapsed = (perf_counter() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    if statements is not None:
+                        queries.append(statements)
+                    if status >= 400:
+                        errors += 1
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(work, drivers, counts))
+        elapsed = perf_counter() - start
+        results[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 3),
+                "p95": round(percentile(latencies, 95), 3),
+                "p99": round(percentile(latencies, 99), 3),
+                "max": round(max(latencies, default=0), 3),
+            },
+            "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+        }
+    return results
@@ -1,10 +1,20 @@
 """
 app/cli.py
 """
+import json
 import os
+import time
+from datetime import datetime, timedelta
 
 import click
-from flask import Flask
+from flask import current_app, Flask
+
+from app import bench as benchmark, db
+from app.email import dispatcher as email_dispatcher, send_announcement
+from app.indexer import indexer as search_indexer
+from app.language import detector as language_detector
+from app.models import Post, SearchableMixin, User
+from app.translate import cache as translation_cache
 
 
 def register(app: Flask) -> None:
@@ -49,3 +59,221 @@ def register(app: Flask) -> None:
         """Compile all languages."""
         if os.system("pybabel compile -d app/translations"):
             raise RuntimeError("compile command failed")
+
+    @translate.command()
+    @click.option("--days", default=7, show_default=True, help="How far back to look for posts.")
+    @click.option("--limit", default=500, show_default=True, help="Most posts per language.")
+    def warm(days: int, limit: int):
+        """Pre-translate recent posts into every supported language."""
+        if current_app.translator is None:
+            raise click.ClickException("the translation service is not configured")
+        since = datetime.utcnow() - timedelta(days=days)
+        for language in current_app.config["LANGUAGES"]:
+            posts = (
+                Post.query.with_entities(Post.body, Post.language)
+                .filter(Post.timestamp >= since, Post.language != "", Post.language != language)
+                .order_by(Post.timestamp.desc())
+                .limit(limit)
+            )
+            cached = translated = failed = 0
+            for body, source_language in posts:
+                if translation_cache.get(body, source_language, language) is not None:
+                    cached += 1
+                    continue
+                translation = current_app.translator.translate(body, source_language, language)
+                if translation is None:
+                    failed += 1
+                    continue
+                translation_cache.set(body, source_language, language, translation)
+                translated += 1
+            click.echo(
+                f"{language}: {translated} translated, {cached} already cached, {failed} failed"
+            )
+
+    @app.cli.group()
+    def email():
+        """Email commands."""
+        pass
+
+    @email.command()
+    @click.option("--subject", required=True, help="Subject line.")
+    @click.option("--message", required=True, help="Text; blank lines split paragraphs.")
+    @click.option("--chunk-size", default=500, show_default=True, help="Recipients per batch.")
+    def announce(subject: str, message: str, chunk_size: int):
+        """Email an announcement to every user."""
+        queued = send_announcement(
+            subject,
+            "announcement",
+            sender=current_app.config["ADMINS"][0],
+            chunk_size=chunk_size,
+            message=message,
+        )
+        click.echo(f"Queued the announcement for {queued} user(s), sending...")
+        email_dispatcher.join()
+        click.echo("Done.")
+
+    @app.cli.group()
+    def language():
+        """Post language detection commands."""
+        pass
+
+    @language.command()
+    @click.option("--batch-size", default=1000, show_default=True, help="Posts per UPDATE.")
+    @click.option(
+        "--include-unknown", is_flag=True, help="Also retry posts with no detectable language."
+    )
+    def backfill(batch_size: int, include_unknown: bool):
+        """Detect the language of posts that have none."""
+        processed = language_detector.backfill(batch_size, include_unknown)
+        click.echo(f"Detected the language of {processed} post(s).")
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline maintenance commands."""
+        pass
+
+    @timeline.command()
+    @click.option("--username", help="Only rebuild this user's timeline.")
+    def rebuild(username: str):
+        """Rebuild materialized home timelines from the followers table."""
+        user = None
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.BadParameter(f"no such user: {username}", param_hint="--username")
+        User.rebuild_timelines(user)
+        db.session.commit()
+        click.echo(f"Rebuilt timeline for {username}." if user else "Rebuilt all timelines.")
+
+    @app.cli.group()
+    def followers():
+        """Follower graph maintenance commands."""
+        pass
+
+    @followers.command()
+    def reconcile():
+        """Recompute drifted follower/following counters from the followers table."""
+        corrected = User.reconcile_follow_counts()
+        db.session.commit()
+        click.echo(f"Corrected counters for {corrected} user(s).")
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    def drain():
+        """Send every queued search index change now."""
+        total = 0
+        while True:
+            processed = search_indexer.drain()
+            if not processed:
+                break
+            total += processed
+        click.echo(f"Processed {total} queued change(s).")
+
+    @search.command()
+    def worker():
+        """Run the search indexer in the foreground, as a separate process."""
+        backend = current_app.search_backend
+        if backend is None or backend.transactional:
+            raise click.ClickException("the search backend does not use the outbox")
+        click.echo("Draining the search outbox, press Ctrl+C to stop.")
+        while True:
+            try:
+                while search_indexer.drain():
+                    pass
+            except Exception as e:
+                current_app.logger.error(f"Search indexer failed: {e}")
+            finally:
+                db.session.remove()
+            time.sleep(current_app.config["SEARCH_QUEUE_POLL_INTERVAL"])
+
+    @search.command()
+    @click.option("--model", "models", multiple=True, help="Table to reindex, defaults to all.")
+    @click.option("--chunk-size", default=1000, show_default=True, help="Documents per request.")
+    @click.option("--workers", default=4, show_default=True, help="Concurrent bulk requests.")
+    @click.option(
+        "--swap/--in-place",
+        default=True,
+        show_default=True,
+        help="Build a new index and swap the alias, or write into the live index.",
+    )
+    def reindex(models, chunk_size: int, workers: int, swap: bool):
+        """Rebuild search indices from the database."""
+        if current_app.search_backend is None:
+            raise click.ClickException("no search backend is configured")
+        searchable = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+        for name in models or searchable:
+            if name not in searchable:
+                raise click.BadParameter(f"not a searchable table: {name}", param_hint="--model")
+
+            def progress(sent: int, elapsed: float) -> None:
+                rate = sent / elapsed if elapsed else 0
+                click.echo(f"\r{name}: {sent} documents, {rate:.0f} docs/s", nl=False)
+
+            start = time.perf_counter()
+            sent, failed = searchable[name].reindex(chunk_size, workers, swap, progress)
+            elapsed = time.perf_counter() - start
+            click.echo(
+                f"\r{name}: {sent} documents in {elapsed:.1f}s "
+                f"({sent / elapsed if elapsed else 0:.0f} docs/s), {failed} rejected"
+            )
+
+    @app.cli.group()
+    def bench():
+        """Load testing commands. Never run these against real data."""
+        pass
+
+    @bench.command()
+    @click.option("--users", default=10000, show_default=True)
+    @click.option("--edges", default=200000, show_default=True, help="Follow relationships.")
+    @click.option("--posts", default=100000, show_default=True)
+    @click.option("--prefix", default="bench", show_default=True, help="Username prefix.")
+    @click.option("--seed", "random_seed", default=0, show_default=True, help="Random seed.")
+    def seed(users: int, edges: int, posts: int, prefix: str, random_seed: int):
+        """Seed a synthetic social graph with a power-law follower distribution."""
+        if edges > users * (users - 1):
+            raise click.BadParameter(
+                "more edges than possible pairs of users", param_hint="--edges"
+            )
+        if User.query.filter(User.username.like(f"{prefix}%")).first() is not None:
+            raise click.ClickException(f"users named {prefix}* already exist, pick another prefix")
+        start = time.perf_counter()
+        seeded = benchmark.seed(users, edges, posts, prefix, random_seed)
+        seeded["seconds"] = round(time.perf_counter() - start, 1)
+        click.echo(json.dumps(seeded))
+
+    @bench.command()
+    @click.option(
+        "--route",
+        "names",
+        multiple=True,
+        type=click.Choice(list(benchmark.routes("", ""))),
+        help="Route to benchmark, defaults to all.",
+    )
+    @click.option("--requests", "count", default=200, show_default=True, help="Per route.")
+    @click.option("--concurrency", default=4, show_default=True, help="Concurrent workers.")
+    @click.option("--warmup", default=10, show_default=True, help="Untimed requests per worker.")
+    @click.option("--url", help="Server to benchmark, e.g. a local gunicorn; default in-process.")
+    @click.option("--prefix", default="bench", show_default=True, help="Seeded username prefix.")
+    @click.option("--term", default="coffee", show_default=True, help="Search term.")
+    @click.option("--output", type=click.File("w"), default="-", help="File for the JSON report.")
+    def run(names, count: int, concurrency: int, warmup: int, url, prefix: str, term: str, output):
+        """Benchmark routes and report latency percentiles, throughput and queries per request."""
+        names = names or list(benchmark.routes("", ""))
+        started_at = datetime.utcnow()
+        try:
+            results = benchmark.run(names, count, concurrency, warmup, url, prefix, term)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        report = {
+            "started_at": started_at.isoformat() + "Z",
+            "target": url or "test-client",
+            "database": db.engine.dialect.name,
+            "concurrency": concurrency,
+            "requests_per_route": count,
+            "routes": results,
+        }
+        output.write(json.dumps(report, indent=2) + "\n")
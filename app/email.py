@@ -1,15 +1,233 @@
-from threading import Thread
-from typing import List, Optional
+import atexit
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
+from babel.support import Translations
 from flask import current_app, Flask
 from flask_mail import Message
+from jinja2 import Environment
 
-from . import mail
+from . import db, mail
 
 
-def send_async_email(app: Flask, msg: Message) -> None:
-    with app.app_context():
-        mail.send(msg)
+def N_(message: str) -> str:
+    """Marks a message for extraction without translating it. Email subjects are translated by the
+    dispatcher, into each recipient's locale.
+    """
+    return message
+
+
+class EmailQueueFull(Exception):
+    """Raised when a message cannot be queued because the dispatcher is saturated"""
+
+
+class EmailContent:
+    """A templated email, rendered by a dispatcher worker the first time it is needed and then
+    shared by every recipient in the same locale
+
+    :param subject: Untranslated subject, marked with N_
+    :type subject: str
+    :param template: Name of the `email/<template>.txt.j2` and `email/<template>.html` templates
+    :type template: str
+    :param locale: Locale to render in
+    :type locale: str
+    :param sender: Sender address, defaults to MAIL_DEFAULT_SENDER
+    :type sender: Optional[str]
+    :param context: Template variables, which must not be database objects since rendering
+        happens in another thread
+    :type context: Dict[str, Any]
+    """
+
+    def __init__(
+        self,
+        subject: str,
+        template: str,
+        locale: str,
+        sender: Optional[str] = None,
+        context: Optional[Dict[str, Any]] = None,
+    ):
+        self.subject = subject
+        self.template = template
+        self.locale = locale
+        self.sender = sender
+        self.context = context or {}
+        self._lock = Lock()
+        self._rendered: Optional[Tuple[str, str, str]] = None
+
+    def render(self) -> Tuple[str, str, str]:
+        """Returns the translated subject and the text and HTML bodies, rendering them once"""
+        with self._lock:
+            if self._rendered is None:
+                self._rendered = render_email(
+                    self.subject, self.template, self.locale, **self.context
+                )
+            return self._rendered
+
+
+class Delivery(NamedTuple):
+    """One queued batch of recipients for an EmailContent. Each recipient gets their own message."""
+
+    content: EmailContent
+    recipients: List[str]
+
+
+class _Pool:
+    """Queue, worker threads and template environments of one app's email dispatcher"""
+
+    def __init__(self, maxsize: int):
+        self.queue: "Queue[Union[Message, Delivery]]" = Queue(maxsize)
+        self.lock = Lock()
+        self.stopping = Event()
+        self.workers: List[Thread] = []
+        self.environments: Dict[str, Tuple[Environment, Translations]] = {}
+
+
+class EmailDispatcher:
+    """Sends email from a bounded queue with a fixed pool of MAIL_WORKERS threads, instead of a
+    thread and an SMTP connection per message.
+
+    Each worker opens one SMTP connection and sends everything that is queued over it before
+    closing it again. Once MAIL_QUEUE_SIZE messages are waiting, `send` blocks for up to
+    MAIL_QUEUE_TIMEOUT seconds and then raises EmailQueueFull. Workers are started with the first
+    message, so processes that never send email never start them, and on interpreter shutdown they
+    finish sending the queue before exiting.
+
+    Besides ready-made messages, the queue takes Deliveries of an EmailContent, which the workers
+    render with a Jinja environment kept per locale, so templates are compiled once per process
+    and rendering stays off the request path.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Attaches an empty queue to the app"""
+        app.extensions["email_dispatcher"] = _Pool(app.config["MAIL_QUEUE_SIZE"])
+
+    @staticmethod
+    def _pool() -> _Pool:
+        return current_app.extensions["email_dispatcher"]
+
+    def send(
+        self, msg: Union[Message, Delivery], timeout: Optional[float] = None, wait: bool = False
+    ) -> None:
+        """Queues a message, or a delivery of templated email, to be sent by the worker pool
+
+        :param msg: Message or delivery to send
+        :type msg: Union[Message, Delivery]
+        :param timeout: Seconds to wait for room in the queue, defaults to MAIL_QUEUE_TIMEOUT
+        :type timeout: Optional[float]
+        :param wait: Whether to wait for room however long it takes, for batch jobs
+        :type wait: bool
+
+        :raises EmailQueueFull: If the queue is still full after the timeout
+        """
+        pool = self._pool()
+        self._start(pool)
+        if wait:
+            pool.queue.put(msg)
+            return
+        if timeout is None:
+            timeout = current_app.config["MAIL_QUEUE_TIMEOUT"]
+        try:
+            pool.queue.put(msg, timeout=timeout)
+        except Full:
+            raise EmailQueueFull(f"{pool.queue.maxsize} messages are already waiting")
+
+    def environment(self, locale: str) -> Tuple[Environment, Translations]:
+        """Returns the Jinja environment for rendering email in a locale, and its translations.
+        Each locale gets an environment of its own, sharing the app's template loader, globals and
+        filters but with the locale's catalog installed, so that templates are compiled once and
+        workers never depend on a request's locale.
+        """
+        pool = self._pool()
+        with pool.lock:
+            if locale not in pool.environments:
+                babel = current_app.extensions["babel"]
+                translations = Translations()
+                for dirname in babel.translation_directories:
+                    translations.merge(Translations.load(dirname, [locale], babel.domain))
+                app_environment = current_app.jinja_env
+                environment = Environment(
+                    loader=app_environment.loader,
+                    autoescape=app_environment.autoescape,
+                    extensions=["jinja2.ext.i18n"],
+                )
+                environment.globals.update(app_environment.globals)
+                environment.filters.update(app_environment.filters)
+                environment.install_gettext_translations(translations, newstyle=True)
+                pool.environments[locale] = (environment, translations)
+            return pool.environments[locale]
+
+    def join(self) -> None:
+        """Blocks until every queued message has been sent or has failed"""
+        self._pool().queue.join()
+
+    def _start(self, pool: _Pool) -> None:
+        with pool.lock:
+            if pool.workers:
+                return
+            app = current_app._get_current_object()
+            for i in range(app.config["MAIL_WORKERS"]):
+                worker = Thread(target=self._work, args=(app, pool), name=f"email-{i}", daemon=True)
+                pool.workers.append(worker)
+                worker.start()
+            atexit.register(self._stop, pool)
+
+    def _work(self, app: Flask, pool: _Pool) -> None:
+        while not (pool.stopping.is_set() and pool.queue.empty()):
+            try:
+                item = pool.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            with app.app_context():
+                self._send_queued(item, pool.queue)
+
+    @staticmethod
+    def _messages(item: Union[Message, Delivery]) -> Iterator[Message]:
+        if isinstance(item, Message):
+            yield item
+            return
+        subject, text_body, html_body = item.content.render()
+        for recipient in item.recipients:
+            yield Message(
+                subject=subject,
+                sender=item.content.sender,
+                recipients=[recipient],
+                body=text_body,
+                html=html_body,
+            )
+
+    def _send_queued(
+        self, item: Optional[Union[Message, Delivery]], queue: "Queue[Union[Message, Delivery]]"
+    ) -> None:
+        """Sends a queued item, and then whatever else is waiting, over a single SMTP connection.
+        After a failure the connection is dropped and the remaining items are left to the next one.
+        """
+        try:
+            with mail.connect() as connection:
+                while item is not None:
+                    try:
+                        for msg in self._messages(item):
+                            connection.send(msg)
+                    finally:
+                        item = None
+                        queue.task_done()
+                    try:
+                        item = queue.get_nowait()
+                    except Empty:
+                        pass
+        except Exception as e:
+            if item is not None:
+                queue.task_done()
+            current_app.logger.error(f"Sending email failed: {e}")
+
+    @staticmethod
+    def _stop(pool: _Pool, timeout: float = 30) -> None:
+        pool.stopping.set()
+        for worker in pool.workers:
+            worker.join(timeout=timeout)
+
+
+dispatcher = EmailDispatcher()
 
 
 def send_email(
@@ -19,9 +237,81 @@ def send_email(
     text_body: Optional[str] = None,
     html_body: Optional[str] = None,
 ) -> None:
-    """Send an email with Flask-Mail"""
+    """Queue an email to be sent with Flask-Mail by the email dispatcher
+
+    :raises EmailQueueFull: If the dispatcher's queue stays full for MAIL_QUEUE_TIMEOUT seconds
+    """
 
     msg = Message(subject=subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    dispatcher.send(msg)
+
+
+def render_email(subject: str, template: str, locale: str, **context: Any) -> Tuple[str, str, str]:
+    """Renders a templated email in a locale
+
+    :return: A tuple containing the translated subject, the text body and the HTML body
+    :rtype: Tuple[str, str, str]
+    """
+    environment, translations = dispatcher.environment(locale)
+    return (
+        translations.gettext(subject),
+        environment.get_template(f"email/{template}.txt.j2").render(context),
+        environment.get_template(f"email/{template}.html").render(context),
+    )
+
+
+def send_template_email(
+    subject: str,
+    template: str,
+    recipients: List[str],
+    locale: str,
+    sender: Optional[str] = None,
+    **context: Any,
+) -> None:
+    """Queue a templated email, which the email dispatcher renders and sends
+
+    :raises EmailQueueFull: If the dispatcher's queue stays full for MAIL_QUEUE_TIMEOUT seconds
+    """
+    content = EmailContent(subject, template, locale, sender, context)
+    dispatcher.send(Delivery(content, list(recipients)))
+
+
+def send_announcement(
+    subject: str,
+    template: str,
+    sender: Optional[str] = None,
+    chunk_size: int = 500,
+    **context: Any,
+) -> int:
+    """Queue a templated email to every user. The email is rendered once per locale, and users are
+    read and queued in chunks of `chunk_size` recipients, so memory use does not grow with the
+    number of users. Waits for room in the queue rather than failing.
+
+    :return: Number of recipients queued
+    :rtype: int
+    """
+    from .models import User
+
+    default_locale = current_app.config["BABEL_DEFAULT_LOCALE"]
+    locale_column = db.func.coalesce(User.locale, default_locale)
+    queued = 0
+    locales: Iterable[str] = [row[0] for row in db.session.query(locale_column).distinct()]
+    for locale in locales:
+        content = EmailContent(subject, template, locale, sender, context)
+        last_id = 0
+        while True:
+            rows = (
+                db.session.query(User.id, User.email)
+                .filter(locale_column == locale, User.id > last_id, User.email.isnot(None))
+                .order_by(User.id)
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            dispatcher.send(Delivery(content, [email for _, email in rows]), wait=True)
+            queued += len(rows)
+    return queued
@@ -0,0 +1,85 @@
+"""
+app/fragments.py
+"""
+from typing import Any, Iterable
+
+from flask import current_app, Flask
+from flask_babel import get_locale
+from jinja2 import contextfunction
+from jinja2.runtime import Context
+from markupsafe import Markup
+from werkzeug.utils import import_string
+
+from .cache import LRUCache
+
+
+class FragmentCache:
+    """Caches the rendered HTML of `_post.html` rows, so that listing pages are assembled from
+    cached rows instead of rendering the template once per post.
+
+    A row only depends on the post, the author's username and the viewer's locale, so that is what
+    it is keyed on: renaming an account in edit_profile changes the key of every row by that
+    author, which invalidates them in every process at once. The post's language is part of the
+    key too, since it is filled in after the post is first shown.
+
+    Rows are kept in an in-process LRU of FRAGMENT_CACHE_SIZE entries by default. Set
+    FRAGMENT_CACHE_BACKEND to the import path of a factory that takes the app and returns an object
+    with the same `get` and `set` methods to share them between processes instead.
+    """
+
+    template = "_post.html"
+    avatar_size = 70
+
+    def init_app(self, app: Flask) -> None:
+        """Creates the app's cache backend and registers the `render_posts` template global"""
+        factory = app.config["FRAGMENT_CACHE_BACKEND"]
+        app.extensions["fragment_cache"] = (
+            import_string(factory)(app)
+            if factory
+            else LRUCache(app.config["FRAGMENT_CACHE_SIZE"], app.config["FRAGMENT_CACHE_TTL"])
+        )
+        app.jinja_env.globals["render_posts"] = render_posts
+
+    @staticmethod
+    def key(post, locale: str) -> str:
+        """Builds the cache key of a post's row"""
+        return f"post:{post.id}:{locale}:{post.language or ''}:{post.author.username}"
+
+    def render(self, context: Context, posts: Iterable[Any]) -> Markup:
+        """Returns the rows of a list of posts, rendering and caching those that are missing
+
+        :param context: Context of the page template, which rows are rendered with
+        :type context: Context
+        :param posts: Posts with their authors loaded
+        :type posts: Iterable[Any]
+
+        :return: The concatenated rows
+        :rtype: Markup
+        """
+        from .models import User
+
+        backend = current_app.extensions["fragment_cache"]
+        locale = str(get_locale())
+        posts = list(posts)
+        keys = [self.key(post, locale) for post in posts]
+        rows = [backend.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            template = context.environment.get_template(self.template)
+            variables = context.get_all()
+            avatars = User.avatars((posts[i].author for i in missing), self.avatar_size)
+            for i in missing:
+                rows[i] = template.render(variables, post=posts[i], avatars=avatars)
+                backend.set(keys[i], rows[i])
+        return Markup("\n".join(rows))
+
+
+cache = FragmentCache()
+
+
+@contextfunction
+def render_posts(context: Context, posts: Iterable[Any]) -> Markup:
+    """Template global that renders a list of posts as `_post.html` rows, from the fragment cache
+    where possible
+    """
+    return cache.render(context, posts)
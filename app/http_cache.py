@@ -0,0 +1,47 @@
+"""
+app/http_cache.py
+"""
+from datetime import datetime
+from hashlib import sha1
+from typing import Any, Optional
+
+from flask import after_this_request, g, request, Response, session
+from flask_login import current_user
+
+
+def conditional(*state: Any, last_modified: Optional[datetime] = None) -> Optional[Response]:
+    """Adds validators to the response of a view, derived from the state the page is built from,
+    and answers revalidations of a fresh copy with 304 Not Modified. Call it with the cheap state
+    before running the view's expensive queries and rendering, and return its response if any.
+
+    The ETag covers the state, the viewer and the locale. Responses are marked private and must be
+    revalidated on every use. Last-Modified is sent for information only, since counters such as
+    followers change without a timestamp, so only If-None-Match is honoured. Nothing is done while
+    flashed messages are pending, since they are consumed by rendering the page.
+
+    :param state: Values that change whenever the page does
+    :type state: Any
+    :param last_modified: Time of the latest change known to the page, if any
+    :type last_modified: Optional[datetime]
+
+    :return: A 304 response if the client's copy is fresh, None otherwise
+    :rtype: Optional[Response]
+    """
+    if request.method != "GET" or session.get("_flashes"):
+        return None
+    viewer = (current_user.id, current_user.username) if current_user.is_authenticated else None
+    etag = sha1(repr((viewer, g.locale) + state).encode("utf-8")).hexdigest()
+
+    @after_this_request
+    def add_validators(response: Response) -> Response:
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
+
+    if etag in request.if_none_match:
+        return Response(status=304)
+    return None
@@ -0,0 +1,134 @@
+"""
+app/indexer.py
+"""
+import atexit
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from typing import Dict, List, Optional
+
+from flask import current_app, Flask
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+from . import db
+from .search import bulk_index, payload_for
+
+
+class SearchIndexer:
+    """Drains the search outbox into Elasticsearch with bulk requests.
+
+    Changes are written to the `search_outbox` table in the same transaction as the objects they
+    describe, so nothing is lost if Elasticsearch is down or the process restarts. A daemon thread
+    per process drains the outbox after each commit and every SEARCH_QUEUE_POLL_INTERVAL seconds;
+    set SEARCH_INDEXER_THREAD=0 to leave the draining to `flask search worker` instead. Failed
+    entries are retried with exponential backoff up to SEARCH_RETRY_MAX_BACKOFF seconds.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Starts the indexer thread for an app, if its search backend uses the outbox"""
+        app.extensions["search_indexer"] = None
+        if app.search_backend is None or app.search_backend.transactional:
+            return
+        if not app.config["SEARCH_INDEXER_THREAD"] or app.testing:
+            return
+        wake, stop = Event(), Event()
+        thread = Thread(
+            target=self.run, args=(app, wake, stop), name="search-indexer", daemon=True
+        )
+        app.extensions["search_indexer"] = (thread, wake, stop)
+        thread.start()
+        atexit.register(self._stop, thread, wake, stop)
+
+    def notify(self) -> None:
+        """Wakes the current app's indexer thread, if it has one"""
+        worker = current_app.extensions.get("search_indexer")
+        if worker is not None:
+            worker[1].set()
+
+    def run(self, app: Flask, wake: Event, stop: Event) -> None:
+        """Drains the outbox whenever woken or polled, until stopped"""
+        while not stop.is_set():
+            wake.wait(app.config["SEARCH_QUEUE_POLL_INTERVAL"])
+            wake.clear()
+            with app.app_context():
+                try:
+                    while self.drain() and not stop.is_set():
+                        pass
+                except Exception as e:
+                    app.logger.error(f"Search indexer failed: {e}")
+                finally:
+                    db.session.remove()
+
+    def drain(self, batch_size: Optional[int] = None) -> int:
+        """Sends one batch of due outbox entries to Elasticsearch. Entries for the same object are
+        collapsed so that only its current state is sent.
+
+        :param batch_size: Maximum number of entries to process, defaults to
+            SEARCH_QUEUE_BATCH_SIZE
+        :type batch_size: Optional[int]
+
+        :return: Number of entries processed, successfully or not
+        :rtype: int
+        """
+        from .models import SearchableMixin, SearchOutbox
+
+        batch_size = batch_size or current_app.config["SEARCH_QUEUE_BATCH_SIZE"]
+        now = datetime.utcnow()
+        entries: List[SearchOutbox] = (
+            SearchOutbox.query.filter(SearchOutbox.available_at <= now)
+            .order_by(SearchOutbox.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not entries:
+            db.session.commit()
+            return 0
+
+        models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+        by_index: Dict[str, Dict[int, List[SearchOutbox]]] = {}
+        for entry in entries:
+            by_index.setdefault(entry.index, {}).setdefault(entry.object_id, []).append(entry)
+
+        for index, objects in by_index.items():
+            model = models.get(index)
+            documents: Dict[int, Optional[Dict]] = dict.fromkeys(objects)
+            if model is not None:
+                for obj in model.query.filter(model.id.in_(list(objects))):
+                    documents[obj.id] = payload_for(obj)
+            try:
+                failed = set(bulk_index(index, documents))
+            except Exception as e:
+                current_app.logger.warning(f"Bulk indexing into {index} failed: {e}")
+                failed = set(objects)
+            for object_id, object_entries in objects.items():
+                for entry in object_entries:
+                    if object_id in failed:
+                        self._retry_later(entry, now)
+                    else:
+                        db.session.delete(entry)
+
+        try:
+            db.session.commit()
+        except (DBAPIError, SQLAlchemyError) as e:
+            db.session.rollback()
+            current_app.logger.error(e)
+            return 0
+        return len(entries)
+
+    @staticmethod
+    def _retry_later(entry, now: datetime) -> None:
+        backoff = min(
+            current_app.config["SEARCH_RETRY_MAX_BACKOFF"],
+            current_app.config["SEARCH_RETRY_BASE_BACKOFF"] * 2 ** entry.attempts,
+        )
+        entry.attempts += 1
+        entry.available_at = now + timedelta(seconds=backoff)
+
+    @staticmethod
+    def _stop(thread: Thread, wake: Event, stop: Event) -> None:
+        stop.set()
+        wake.set()
+        thread.join(timeout=10)
+
+
+indexer = SearchIndexer()
@@ -0,0 +1,371 @@
+"""
+app/instrumentation.py
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from functools import partial
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from flask import (
+    before_render_template,
+    current_app,
+    Flask,
+    g,
+    has_request_context,
+    request,
+    Response,
+    template_rendered,
+)
+from sqlalchemy.engine import Engine
+
+from . import db
+from .pool import pool_gauges, TimedQueuePool
+from .replicas import router as replica_router
+
+
+#: Statements slower than SLOW_QUERY_THRESHOLD, written to logs/slow_queries.log by create_app
+slow_query_logger = logging.getLogger("microblog.slow_queries")
+
+
+class QueryLimitExceeded(RuntimeError):
+    """Raised when a request issues more SQL statements than QUERY_COUNT_LIMIT allows"""
+
+
+class QueryCounter:
+    """Counts the SQL statements executed by the thread that registered it"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements: List[str] = []
+
+
+class RequestTimings:
+    """Time spent by the thread handling a request in the database, in templates and in outbound
+    HTTP calls, in seconds
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.http = 0.0
+        self._template_starts: List[float] = []
+
+
+_local = threading.local()
+
+
+def _active_counters() -> List[QueryCounter]:
+    if not hasattr(_local, "counters"):
+        _local.counters = []
+    return _local.counters
+
+
+def _active_timings() -> Optional[RequestTimings]:
+    return getattr(_local, "timings", None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    for counter in _active_counters():
+        counter.count += 1
+        counter.statements.append(statement)
+    if _active_timings() is not None:
+        conn.info.setdefault("query_starts", []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    timings = _active_timings()
+    starts = conn.info.get("query_starts")
+    if timings is not None and starts:
+        timings.queries += 1
+        timings.db += perf_counter() - starts.pop()
+
+
+db.event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+db.event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@contextmanager
+def outbound_http() -> Iterator[None]:
+    """Counts the time spent inside the `with` block towards the current request's outbound HTTP
+    time. Does nothing outside of instrumented requests.
+    """
+    timings = _active_timings()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.http += perf_counter() - start
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """Counts the SQL statements executed by the current thread inside the `with` block"""
+    counter = QueryCounter()
+    counters = _active_counters()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+def init_app(app: Flask) -> None:
+    """Registers the request metrics if enabled, and the per-request query count check. The check
+    is only active in debug and testing, and only when QUERY_COUNT_LIMIT is set.
+    """
+    init_request_metrics(app)
+    init_slow_query_log(app)
+    if not app.debug and not app.testing:
+        return
+
+    @app.before_request
+    def start_query_count():
+        g.query_counter = QueryCounter()
+        _active_counters().append(g.query_counter)
+
+    @app.after_request
+    def check_query_count(response):
+        limit = current_app.config["QUERY_COUNT_LIMIT"]
+        counter = g.get("query_counter")
+        if limit is None or counter is None or counter.count <= limit:
+            return response
+        message = (
+            f"{request.method} {request.path} ({request.endpoint}) issued {counter.count} "
+            f"queries, more than QUERY_COUNT_LIMIT={limit}"
+        )
+        if current_app.config["QUERY_COUNT_STRICT"]:
+            raise QueryLimitExceeded(message + ":\n" + "\n".join(counter.statements))
+        current_app.logger.warning(message)
+        return response
+
+    @app.teardown_request
+    def stop_query_count(exc):
+        counter = g.pop("query_counter", None)
+        if counter is not None and counter in _active_counters():
+            _active_counters().remove(counter)
+
+
+class Histogram:
+    """A Prometheus histogram with labels, kept in-process"""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            total[0] += value
+
+    def exposition(self) -> List[str]:
+        """Returns the histogram in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in key)
+                prefix = labels + "," if labels else ""
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {counts[-1]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total[0]}")
+                lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return lines
+
+
+class RequestMetrics:
+    """Histograms of one app's requests, and the gauges reported next to them"""
+
+    def __init__(self):
+        durations = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+        self.duration = Histogram(
+            "microblog_request_duration_seconds", "Time spent handling requests.", durations
+        )
+        self.db_duration = Histogram(
+            "microblog_request_db_duration_seconds", "Time spent in SQL per request.", durations
+        )
+        self.queries = Histogram(
+            "microblog_request_queries", "SQL statements per request.", (1, 2, 5, 10, 20, 50, 100)
+        )
+        self.pool_wait = Histogram(
+            "microblog_db_pool_wait_seconds",
+            "Time spent waiting for a pooled database connection.",
+            (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+        )
+        # Callables returning {name: value} gauges, such as cache statistics. Names may carry
+        # labels, as in `name{label="value"}`.
+        self.gauges: List[Callable[[], Dict[str, float]]] = []
+
+    def exposition(self) -> str:
+        lines = self.duration.exposition() + self.db_duration.exposition()
+        lines += self.queries.exposition() + self.pool_wait.exposition()
+        typed = set()
+        for gauges in self.gauges:
+            for name, value in sorted(gauges().items()):
+                family = name.split("{")[0]
+                if family not in typed:
+                    typed.add(family)
+                    lines.append(f"# TYPE {family} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _cache_gauges() -> Dict[str, float]:
+    from .translate import cache as translation_cache
+
+    gauges = {
+        f"microblog_translation_cache_{name}": value
+        for name, value in translation_cache.stats().items()
+    }
+    fragments = current_app.extensions["fragment_cache"]
+    if hasattr(fragments, "stats"):
+        gauges.update(
+            {f"microblog_fragment_cache_{name}": value for name, value in fragments.stats().items()}
+        )
+    return gauges
+
+
+def init_request_metrics(app: Flask) -> None:
+    """Times every request's SQL, template rendering and outbound HTTP calls, reports them in a
+    Server-Timing header and keeps histograms of them, served in the Prometheus text format at
+    METRICS_ENDPOINT along with the state of the connection pools and their checkout waits. Only
+    active when REQUEST_METRICS is set. Histograms are per process, so each worker of a
+    multi-process server must be scraped on its own.
+    """
+    if not app.config["REQUEST_METRICS"]:
+        return
+    metrics = app.extensions["request_metrics"] = RequestMetrics()
+    metrics.gauges.append(_cache_gauges)
+
+    with app.app_context():
+        engines = {"primary": db.engine}
+    for i, engine in enumerate(replica_router.engines(app)):
+        engines[f"replica{i}"] = engine
+    for database, engine in engines.items():
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.observe = partial(metrics.pool_wait.observe, database=database)
+    metrics.gauges.append(partial(pool_gauges, engines))
+
+    @app.before_request
+    def start_timings():
+        _local.timings = RequestTimings()
+
+    def template_started(sender, template, context, **extra):
+        timings = _active_timings()
+        if timings is not None:
+            timings._template_starts.append(perf_counter())
+
+    def template_finished(sender, template, context, **extra):
+        timings = _active_timings()
+        if timings is not None and timings._template_starts:
+            timings.template += perf_counter() - timings._template_starts.pop()
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
+
+    @app.after_request
+    def report_timings(response):
+        timings = _active_timings()
+        if timings is None:
+            return response
+        total = perf_counter() - timings.start
+        response.headers["Server-Timing"] = ", ".join(
+            [
+                f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+                f"tpl;dur={timings.template * 1000:.1f}",
+                f"http;dur={timings.http * 1000:.1f}",
+                f"total;dur={total * 1000:.1f}",
+            ]
+        )
+        endpoint = request.endpoint or "unmatched"
+        metrics.duration.observe(total, endpoint=endpoint, method=request.method)
+        metrics.db_duration.observe(timings.db, endpoint=endpoint)
+        metrics.queries.observe(timings.queries, endpoint=endpoint)
+        return response
+
+    @app.teardown_request
+    def stop_timings(exc):
+        _local.timings = None
+
+    def serve_metrics():
+        return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule(app.config["METRICS_ENDPOINT"], "metrics", serve_metrics)
+
+
+def _query_origin() -> str:
+    """Describes where the current statement comes from: the request and view, or the thread"""
+    if has_request_context():
+        return f"{request.method} {request.path} ({request.endpoint})"
+    return f"thread {threading.current_thread().name}"
+
+
+def _explain(connection, statement: str, parameters, analyze: bool) -> str:
+    """Returns the Postgres plan of a statement, run on its own DBAPI connection inside a savepoint
+    so that a failure cannot abort the caller's transaction. Only SELECTs are analyzed, since
+    EXPLAIN ANALYZE executes the statement again.
+    """
+    analyze = analyze and statement.lstrip()[:6].upper() == "SELECT"
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        return plan
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
+    finally:
+        cursor.close()
+
+
+def init_slow_query_log(app: Flask) -> None:
+    """Logs every statement of the app's engines, replicas included, that takes longer than
+    SLOW_QUERY_THRESHOLD seconds, with its parameters and the request or thread that issued it.
+    On Postgres, the plan is logged too when SLOW_QUERY_EXPLAIN is set, measured with EXPLAIN
+    ANALYZE when SLOW_QUERY_EXPLAIN_ANALYZE is also set.
+    """
+    threshold = app.config["SLOW_QUERY_THRESHOLD"]
+    if threshold is None:
+        return
+    explain = app.config["SLOW_QUERY_EXPLAIN"]
+    analyze = app.config["SLOW_QUERY_EXPLAIN_ANALYZE"]
+    with app.app_context():
+        engines = [db.engine] + replica_router.engines(app)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_starts", []).append(perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("slow_query_starts")
+        if not starts:
+            return
+        elapsed = perf_counter() - starts.pop()
+        if elapsed < threshold:
+            return
+        message = (
+            f"{elapsed * 1000:.1f} ms in {_query_origin()}\n{statement}\n"
+            f"parameters: {repr(parameters)[:1000]}"
+        )
+        if explain and not executemany and conn.dialect.name == "postgresql":
+            message += "\n" + _explain(conn.connection, statement, parameters, analyze)
+        slow_query_logger.warning(message)
+
+    for engine in engines:
+        db.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        db.event.listen(engine, "after_cursor_execute", after_cursor_execute)
@@ -0,0 +1,172 @@
+"""
+app/language.py
+"""
+import atexit
+from hashlib import sha256
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import List, Optional, Tuple
+
+from flask import current_app, Flask
+from guess_language import guess_language
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+from . import db
+from .cache import LRUCache
+
+
+class _State:
+    """Memo and pending detections of one app's language detector"""
+
+    def __init__(self, cache_size: int, queue_size: int):
+        self.memo = LRUCache(cache_size)
+        self.queue: "Queue[Tuple[int, str]]" = Queue(queue_size)
+        self.wake = Event()
+        self.stop = Event()
+        self.thread: Optional[Thread] = None
+
+
+class LanguageDetector:
+    """Detects the language of posts with guess_language, off the request path.
+
+    New posts are stored with a NULL language and queued with `defer`; a daemon thread per process
+    detects them after commit and fills the column in with a bulk UPDATE. The thread loads the
+    detector's trigram models when it starts, so no request pays for that. Results are memoized
+    by body, so reposted text is only analysed once. Posts whose detection was lost, e.g. because
+    the process exited, are picked up by `flask language backfill`.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Attaches a fresh queue to the app and starts the detector thread outside of testing"""
+        state = app.extensions["language_detector"] = _State(
+            app.config["LANGUAGE_CACHE_SIZE"], app.config["LANGUAGE_QUEUE_SIZE"]
+        )
+        if app.testing:
+            return
+        state.thread = Thread(
+            target=self.run, args=(app, state), name="language-detector", daemon=True
+        )
+        state.thread.start()
+        atexit.register(self._stop, state)
+
+    @staticmethod
+    def _state() -> _State:
+        return current_app.extensions["language_detector"]
+
+    def detect(self, text: str) -> str:
+        """Returns the language code of a text, or an empty string if it cannot be told"""
+        memo = self._state().memo
+        key = sha256(text.encode("utf-8")).hexdigest()
+        language = memo.get(key)
+        if language is None:
+            language = guess_language(text)
+            if language == "UNKNOWN" or len(language) > 5:
+                language = ""
+            memo.set(key, language)
+        return language
+
+    def defer(self, post_id: int, body: str) -> None:
+        """Queues a committed post for detection. If the queue is full the post keeps its NULL
+        language until the next backfill.
+        """
+        state = self._state()
+        try:
+            state.queue.put_nowait((post_id, body))
+        except Full:
+            current_app.logger.warning(f"Language detection queue is full, skipped post {post_id}")
+            return
+        state.wake.set()
+
+    def run(self, app: Flask, state: _State) -> None:
+        """Preloads the detector, then detects queued posts whenever woken, until stopped"""
+        guess_language("Preloading the language models.")
+        while not state.stop.is_set():
+            state.wake.wait()
+            state.wake.clear()
+            with app.app_context():
+                try:
+                    while self.drain():
+                        pass
+                except Exception as e:
+                    app.logger.error(f"Language detection failed: {e}")
+
+    def drain(self, batch_size: Optional[int] = None) -> int:
+        """Detects one batch of queued posts and writes their languages with one UPDATE
+
+        :param batch_size: Maximum number of posts to process, defaults to LANGUAGE_BATCH_SIZE
+        :type batch_size: Optional[int]
+
+        :return: Number of posts processed
+        :rtype: int
+        """
+        state = self._state()
+        batch: List[Tuple[int, str]] = []
+        for _ in range(batch_size or current_app.config["LANGUAGE_BATCH_SIZE"]):
+            try:
+                batch.append(state.queue.get_nowait())
+            except Empty:
+                break
+        if batch:
+            self._store([(id, self.detect(body)) for id, body in batch])
+        return len(batch)
+
+    def backfill(self, batch_size: int = 1000, include_unknown: bool = False) -> int:
+        """Detects and stores the language of every post that has none, in batches
+
+        :param batch_size: Posts per UPDATE, defaults to 1000
+        :type batch_size: int
+        :param include_unknown: Whether to retry posts already found to have no detectable language
+        :type include_unknown: bool
+
+        :return: Number of posts processed
+        :rtype: int
+        """
+        from .models import Post
+
+        missing = Post.language.is_(None)
+        if include_unknown:
+            missing = db.or_(missing, Post.language == "")
+        processed, last_id = 0, 0
+        while True:
+            rows = (
+                db.session.query(Post.id, Post.body)
+                .filter(missing, Post.id > last_id)
+                .order_by(Post.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                return processed
+            last_id = rows[-1][0]
+            self._store([(id, self.detect(body)) for id, body in rows], only_missing=False)
+            processed += len(rows)
+
+    @staticmethod
+    def _store(languages: List[Tuple[int, str]], only_missing: bool = True) -> None:
+        """Writes detected languages in a single executemany UPDATE, in a transaction of its own.
+        Unless told otherwise, languages that were set in the meantime are left alone.
+        """
+        from .models import Post
+
+        table = Post.__table__
+        condition = table.c.id == db.bindparam("_id")
+        if only_missing:
+            condition = db.and_(condition, table.c.language.is_(None))
+        statement = table.update().where(condition).values(language=db.bindparam("_language"))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    statement, [{"_id": id, "_language": language} for id, language in languages]
+                )
+        except (DBAPIError, SQLAlchemyError) as e:
+            current_app.logger.error(e)
+
+    @staticmethod
+    def _stop(state: _State) -> None:
+        state.stop.set()
+        state.wake.set()
+        if state.thread is not None:
+            state.thread.join(timeout=10)
+
+
+detector = LanguageDetector()
@@ -0,0 +1,104 @@
+"""
+app/last_seen.py
+"""
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from typing import Dict
+
+from flask import current_app, Flask
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+from . import db
+
+
+class _Buffer:
+    """Pending last_seen values for one app, keyed by user id"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending: Dict[int, datetime] = {}
+        self.flushed_at = monotonic()
+
+
+class LastSeenTracker:
+    """Records user activity in memory and writes it to the user table in batches, instead of
+    committing `last_seen` on every request.
+
+    A user's activity is only recorded once their stored `last_seen` is older than
+    LAST_SEEN_MAX_STALENESS. Recorded values are written with one bulk UPDATE once
+    LAST_SEEN_FLUSH_INTERVAL seconds have passed or LAST_SEEN_FLUSH_THRESHOLD users are pending,
+    so a displayed "Last seen" lags by at most the sum of the staleness and the flush interval.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Attaches a fresh buffer to the app and flushes it on interpreter shutdown"""
+        buffer = app.extensions["last_seen"] = _Buffer()
+        if not app.testing:
+            atexit.register(self._flush_at_exit, app, buffer)
+
+    @staticmethod
+    def _buffer() -> _Buffer:
+        return current_app.extensions["last_seen"]
+
+    def record(self, user) -> None:
+        """Notes that a user was active just now, flushing the buffer if it is due"""
+        now = datetime.utcnow()
+        staleness = timedelta(seconds=current_app.config["LAST_SEEN_MAX_STALENESS"])
+        if user.last_seen is not None and now - user.last_seen < staleness:
+            return
+        buffer = self._buffer()
+        with buffer.lock:
+            buffer.pending[user.id] = now
+            due = (
+                len(buffer.pending) >= current_app.config["LAST_SEEN_FLUSH_THRESHOLD"]
+                or monotonic() - buffer.flushed_at >= current_app.config["LAST_SEEN_FLUSH_INTERVAL"]
+            )
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes all pending last_seen values in a single executemany UPDATE, in a transaction of
+        its own so that the request's session is left untouched.
+
+        :return: Number of users written
+        :rtype: int
+        """
+        from .models import User
+
+        buffer = self._buffer()
+        with buffer.lock:
+            pending, buffer.pending = buffer.pending, {}
+            buffer.flushed_at = monotonic()
+        if not pending:
+            return 0
+
+        table = User.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == db.bindparam("_id"))
+            .values(last_seen=db.bindparam("_last_seen"))
+        )
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    statement,
+                    [{"_id": id, "_last_seen": seen} for id, seen in pending.items()],
+                )
+        except (DBAPIError, SQLAlchemyError) as e:
+            current_app.logger.error(e)
+            # Put the values back unless a newer one was recorded in the meantime
+            with buffer.lock:
+                for id, seen in pending.items():
+                    buffer.pending.setdefault(id, seen)
+            return 0
+        return len(pending)
+
+    def _flush_at_exit(self, app: Flask, buffer: _Buffer) -> None:
+        if buffer.pending:
+            with app.app_context():
+                self.flush()
+
+
+tracker = LastSeenTracker()
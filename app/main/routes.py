@@ -1,19 +1,27 @@
 """
 app/routes.py
 """
-from datetime import datetime
 from typing import Optional
 
 from flask import current_app, flash, g, jsonify, redirect, render_template, request, url_for
 from flask_babel import _, get_locale
 from flask_login import current_user, login_required
-from flask_sqlalchemy import Pagination
-from guess_language import guess_language
 from sqlalchemy.exc import DBAPIError, SQLAlchemyError
 
 from app import db
+from app.http_cache import conditional
+from app.language import detector as language_detector
+from app.last_seen import tracker as last_seen_tracker
 from app.models import Post, User
-from app.translate import translate
+from app.pagination import (
+    decode_cursor,
+    decode_sort_values,
+    keyset_paginate,
+    KeysetPagination,
+    SearchPagination,
+)
+from app.replicas import use_primary
+from app.translate import translate, translate_batch
 
 from . import bp
 from .forms import EditProfileForm, PostForm, SearchForm
@@ -22,23 +30,12 @@ from .forms import EditProfileForm, PostForm, SearchForm
 @bp.before_request
 def before_request():
     """
-    Common functionality to be processed before every request. Updates user's last_seen.
-
-    TODO: Update to only overwrite last_seen in the database if last_seen is earlier than today
-    - This might not work nicely because of time zone conversion -- could be the same day
-    locally but different days in UTC, or vice-versa
-    - But I don't like having a database write on every single request by a logged-in user
-    - Could do if last_seen is greater than an hour old
-    - Or just if last_seen UTC is earlier than today UTC
+    Common functionality to be processed before every request. Records the user's activity with
+    the last_seen tracker, which writes it to the database in batches rather than committing here.
     """
 
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        try:
-            db.session.commit()
-        except (DBAPIError, SQLAlchemyError):
-            db.session.rollback()
-
+        last_seen_tracker.record(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -51,10 +48,8 @@ def index():
 
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == "UNKNOWN" or len(language) > 5:
-            language = ""
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # The language is detected in the background once the post is committed
+        post = Post(body=form.post.data, author=current_user)
         try:
             db.session.add(post)
             db.session.commit()
@@ -63,15 +58,23 @@ def index():
             flash(_("Could not process your post, please try again!"))
             current_app.logger.error(e)
         else:
+            language_detector.defer(post.id, form.post.data)
             flash(_("Your post is now live!"))
         return redirect(url_for("main.index"))
 
-    page = request.args.get("page", default=1, type=int)
-    posts: Pagination = current_user.followed_posts().paginate(
-        page, current_app.config["POSTS_PER_PAGE"], error_out=False
+    posts: KeysetPagination = keyset_paginate(
+        current_user.followed_posts().options(db.joinedload(Post.author)),
+        current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before", type=decode_cursor),
+        after=request.args.get("after", type=decode_cursor),
+        keys=current_user.followed_posts_keys(),
     )
-    next_url: Optional[str] = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url: Optional[str] = url_for("main.index", page=posts.prev_num) if posts.has_prev else None
+    next_url: Optional[str] = url_for(
+        "main.index", before=posts.next_cursor
+    ) if posts.has_next else None
+    prev_url: Optional[str] = url_for(
+        "main.index", after=posts.prev_cursor
+    ) if posts.has_prev else None
     return render_template(
         "index.html",
         title=_("Home"),
@@ -85,37 +88,83 @@ def index():
 @bp.route("/explore")
 @login_required
 def explore():
-    """View for displaying recent posts by all users"""
+    """View for displaying recent posts by all users. Revalidations are answered from the newest
+    post alone.
+    """
 
-    page = request.args.get("page", default=1, type=int)
-    posts: Pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], error_out=False
+    latest = Post.latest()
+    not_modified = conditional(latest, last_modified=latest and latest.timestamp)
+    if not_modified is not None:
+        return not_modified
+    posts: KeysetPagination = keyset_paginate(
+        Post.query.options(db.joinedload(Post.author)),
+        current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before", type=decode_cursor),
+        after=request.args.get("after", type=decode_cursor),
     )
-    next_url: Optional[str] = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url: Optional[str] = url_for("main.index", page=posts.prev_num) if posts.has_prev else None
+    next_url: Optional[str] = url_for(
+        "main.explore", before=posts.next_cursor
+    ) if posts.has_next else None
+    prev_url: Optional[str] = url_for(
+        "main.explore", after=posts.prev_cursor
+    ) if posts.has_prev else None
     return render_template(
         "index.html", title=_("Explore"), posts=posts.items, next_url=next_url, prev_url=prev_url,
     )
 
 
+def profile_state(user: User, is_following: bool) -> tuple:
+    """Returns everything shown about a user on their profile and popup, for HTTP validators"""
+    return (
+        user.id,
+        user.username,
+        user.email,
+        user.about_me,
+        user.last_seen,
+        user.follower_count,
+        user.following_count,
+        is_following,
+    )
+
+
 @bp.route("/user/<username>")
 @login_required
 def user(username):
-    """User profile view"""
+    """User profile view. Revalidations are answered from the user row and their newest post."""
 
-    user: User = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", default=1, type=int)
-    posts: Pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], error_out=False
+    user, is_following = (
+        User.query.add_columns(User.followed_by(current_user))
+        .filter(User.username == username)
+        .first_or_404()
+    )
+    latest = Post.latest(Post.user_id == user.id)
+    changes = [user.last_seen, latest and latest.timestamp]
+    not_modified = conditional(
+        latest,
+        *profile_state(user, is_following),
+        last_modified=max(filter(None, changes), default=None),
+    )
+    if not_modified is not None:
+        return not_modified
+    posts: KeysetPagination = keyset_paginate(
+        user.posts.options(db.joinedload(Post.author)),
+        current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before", type=decode_cursor),
+        after=request.args.get("after", type=decode_cursor),
     )
     next_url: Optional[str] = url_for(
-        "main.user", username=user.username, page=posts.next_num
+        "main.user", username=user.username, before=posts.next_cursor
     ) if posts.has_next else None
     prev_url: Optional[str] = url_for(
-        "main.user", username=user.username, page=posts.prev_num
+        "main.user", username=user.username, after=posts.prev_cursor
     ) if posts.has_prev else None
     return render_template(
-        "user.html", user=user, posts=posts.items, next_url=next_url, prev_url=prev_url
+        "user.html",
+        user=user,
+        is_following=is_following,
+        posts=posts.items,
+        next_url=next_url,
+        prev_url=prev_url,
     )
 
 
@@ -146,6 +195,7 @@ def edit_profile():
 
 @bp.route("/follow/<username>")
 @login_required
+@use_primary
 def follow(username):
     """Endpoint for following another user"""
     user: Optional[User] = User.query.filter_by(username=username).first()
@@ -163,6 +213,7 @@ def follow(username):
 
 @bp.route("/unfollow/<username>")
 @login_required
+@use_primary
 def unfollow(username):
     """Endpoint for unfollowing another user"""
     user: Optional[User] = User.query.filter_by(username=username).first()
@@ -191,28 +242,80 @@ def translate_text():
     )
 
 
+@bp.route("/translate/batch", methods=["POST"])
+@login_required
+def translate_posts():
+    """Translates a list of posts from a JSON request into one language, and serializes the
+    translations into a JSON object keyed by post ID
+    """
+    data = request.get_json(silent=True) or {}
+    ids, dest_language = data.get("ids"), data.get("dest_language")
+    if (
+        not isinstance(ids, list)
+        or not all(isinstance(id, int) for id in ids)
+        or len(ids) > current_app.config["TRANSLATE_BATCH_LIMIT"]
+        or dest_language not in current_app.config["LANGUAGES"]
+    ):
+        return jsonify({"error": _("Invalid translation request")}), 400
+
+    posts = (
+        db.session.query(Post.id, Post.body, Post.language)
+        .filter(Post.id.in_(list(set(ids))), Post.language != "")
+        .all()
+        if ids
+        else []
+    )
+    translations = translate_batch(
+        ((body, language) for id, body, language in posts), dest_language
+    )
+    if current_app.translator is None:
+        error = _("Error: the translation service is not configured.")
+    else:
+        error = _("Error: the translation service failed")
+    return jsonify(
+        {
+            "translations": {
+                id: translations[body, language] or error for id, body, language in posts
+            }
+        }
+    )
+
+
 @bp.route("/search")
 @login_required
 def search():
     """Returns the results of full-text search"""
     if g.search_form is None or not g.search_form.validate():
         return redirect(url_for("main.explore"))
-    page = request.args.get("page", default=1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config["POSTS_PER_PAGE"])
-    next_url = (
-        url_for("main.search", q=g.search_form.q.data, page=page + 1)
-        if total > page * current_app.config["POSTS_PER_PAGE"]
-        else None  # could this be changed to `if total > posts.count() else None`?
-    )
-    prev_url = url_for("main.search", q=g.search_form.q.data, page=page - 1) if page > 1 else None
+    posts: SearchPagination = Post.search(
+        g.search_form.q.data,
+        current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before", type=decode_sort_values),
+        after=request.args.get("after", type=decode_sort_values),
+    )
+    next_url: Optional[str] = url_for(
+        "main.search", q=g.search_form.q.data, before=posts.next_cursor
+    ) if posts.has_next else None
+    prev_url: Optional[str] = url_for(
+        "main.search", q=g.search_form.q.data, after=posts.prev_cursor
+    ) if posts.has_prev else None
     return render_template(
-        "search.html", title=_("Search"), posts=posts, next_url=next_url, prev_url=prev_url
+        "search.html", title=_("Search"), posts=posts.items, next_url=next_url, prev_url=prev_url
     )
 
 
 @bp.route("/user/<username>/popup")
 @login_required
 def user_popup(username):
-    """View for user info popup"""
-    user = User.query.filter_by(username=username).first_or_404()
-    return render_template("user_popup.html", user=user)
+    """View for user info popup. The user, their counters and the following state come from a
+    single query.
+    """
+    user, is_following = (
+        User.query.add_columns(User.followed_by(current_user))
+        .filter(User.username == username)
+        .first_or_404()
+    )
+    not_modified = conditional(*profile_state(user, is_following), last_modified=user.last_seen)
+    if not_modified is not None:
+        return not_modified
+    return render_template("user_popup.html", user=user, is_following=is_following)
@@ -2,77 +2,258 @@
 app/models.py
 """
 from datetime import datetime
+from functools import lru_cache
 from hashlib import md5
 from time import time
-from typing import Optional, List, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, List, Tuple, Union
 
 import jwt
 from flask import current_app
 from flask_login import UserMixin
 from flask_sqlalchemy import BaseQuery
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm.session import Session
+from sqlalchemy.sql import ColumnElement
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from . import db, login
-from .search import add_to_index, query_index, remove_from_index
+from .indexer import indexer as search_indexer
+from .pagination import SearchPagination
+from .search import create_search_tables, drop_search_tables, payload_for, query_index
+
+
+@lru_cache(maxsize=4096)
+def gravatar_digest(email: str) -> str:
+    """Returns the Gravatar hash of an email address. Memoized on the address itself, so that a
+    changed address never gets a stale digest.
+    """
+    return md5(email.lower().encode("utf-8")).hexdigest()
+
+
+def gravatar_url(email: str, size: Union[str, int]) -> str:
+    """Returns the URL of the Gravatar image for an email address"""
+    return f"https://www.gravatar.com/avatar/{gravatar_digest(email)}?d=retro&s={size}"
 
 
 class SearchableMixin:
-    """Implements common functionality for Elasticsearch integration"""
+    """Implements common functionality for full-text search integration"""
 
     __searchable__: List[str] = []
+    # Relationships loaded alongside search results, so rendering them does not trigger lazy loads
+    __search_eager__: List[str] = []
 
     @classmethod
-    def search(cls, expression: str, page: int, per_page: int) -> Tuple[BaseQuery, int]:
-        """Run an Elasticsearch query and return the database objects"""
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if not total:
-            return cls.query.filter_by(id=0), 0
-        when = [(ids[i], i) for i in range(len(ids))]
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+    def search(
+        cls,
+        expression: str,
+        per_page: int,
+        before: Optional[List[Any]] = None,
+        after: Optional[List[Any]] = None,
+        query: Optional[BaseQuery] = None,
+    ) -> SearchPagination:
+        """
+        Runs a full-text query and returns one page of database objects in relevance order. The
+        objects are fetched with a single IN query, with the relationships named in
+        __search_eager__ joined in, and put back in the ranking's order in Python.
+
+        :param expression: Query string to search
+        :type expression: str
+        :param per_page: Number of results per page
+        :type per_page: int
+        :param before: Sort values to fetch less relevant results from, defaults to the best match
+        :type before: Optional[List[Any]]
+        :param after: Sort values to fetch more relevant results from, takes precedence over
+            `before`
+        :type after: Optional[List[Any]]
+        :param query: Query to fetch the results with, e.g. one selecting only some columns, which
+            must include `id`; defaults to the model with __search_eager__ joined in
+        :type query: Optional[BaseQuery]
+
+        :return: The requested page
+        :rtype: SearchPagination
+        """
+        if after is not None:
+            hits = query_index(cls.__tablename__, expression, per_page + 1, after, ascending=True)
+            has_next, has_prev = True, len(hits) > per_page
+            hits = hits[:per_page][::-1]
+        else:
+            hits = query_index(cls.__tablename__, expression, per_page + 1, before)
+            has_next, has_prev = len(hits) > per_page, before is not None
+            hits = hits[:per_page]
+
+        objects: Dict[int, Any] = {}
+        if hits:
+            if query is None:
+                eager = [db.joinedload(getattr(cls, name)) for name in cls.__search_eager__]
+                query = cls.query.options(*eager)
+            objects = {obj.id: obj for obj in query.filter(cls.id.in_([id for id, _ in hits]))}
+        # Hits can outlive their rows until the indexer catches up, so skip those
+        items = [objects[id] for id, _ in hits if id in objects]
+        return SearchPagination(items, [values for _, values in hits], has_next, has_prev)
 
     @classmethod
-    def before_commit(cls, session: Session) -> None:
-        """Registers session changes in a _changes dict"""
-        session._changes = {
-            "add": list(session.new),
-            "update": list(session.dirty),
-            "delete": list(session.deleted),
-        }
+    def after_flush(cls, session: Session, flush_context) -> None:
+        """
+        Propagates flushed changes to searchable objects to the search backend. Database backends
+        are updated directly in the flushing transaction; for Elasticsearch, the changes are
+        recorded in the search outbox and sent by the indexer after commit.
+        """
+        backend = current_app.search_backend
+        if backend is None:
+            return
+        changes: Dict[str, Dict[int, Optional[Dict[str, Any]]]] = {}
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                changes.setdefault(obj.__tablename__, {})[obj.id] = payload_for(obj)
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and any(
+                db.inspect(obj).attrs[field].history.has_changes() for field in obj.__searchable__
+            ):
+                changes.setdefault(obj.__tablename__, {})[obj.id] = payload_for(obj)
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes.setdefault(obj.__tablename__, {})[obj.id] = None
+        if not changes:
+            return
+
+        if backend.transactional:
+            for index, documents in changes.items():
+                backend.bulk_index(index, documents, session.connection())
+            return
+        session.connection().execute(
+            SearchOutbox.__table__.insert(),
+            [
+                {"index": index, "object_id": id, "op": "delete" if payload is None else "index"}
+                for index, documents in changes.items()
+                for id, payload in documents.items()
+            ],
+        )
+        session.info["search_outbox_pending"] = True
 
     @classmethod
     def after_commit(cls, session: Session) -> None:
+        """Wakes the background indexer if the committed transaction queued any changes"""
+        if session.info.pop("search_outbox_pending", False):
+            search_indexer.notify()
+
+    @classmethod
+    def stream_documents(
+        cls, chunk_size: int, after_id: int = 0
+    ) -> Iterator[Dict[int, Dict[str, Any]]]:
+        """Yields the searchable fields of every row with an ID above `after_id`, in chunks read by
+        primary key range, without loading ORM objects
         """
-        Reads from the session._changes dict and updates the Elasticsearch index for affected
-        objects
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        while True:
+            rows = (
+                db.session.query(cls.id, *columns)
+                .filter(cls.id > after_id)
+                .order_by(cls.id)
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                return
+            yield {row[0]: dict(zip(cls.__searchable__, row[1:])) for row in rows}
+            after_id = rows[-1][0]
+
+    @classmethod
+    def reindex(
+        cls,
+        chunk_size: int = 1000,
+        workers: int = 4,
+        swap: bool = False,
+        progress: Optional[Callable[[int, float], None]] = None,
+    ) -> Tuple[int, int]:
+        """Indexes or re-indexes all objects in cls. Elasticsearch receives streamed, parallel bulk
+        requests; database backends rebuild their full-text table with a single statement.
+
+        With `swap`, Elasticsearch documents are written to a new index that then replaces the old
+        one behind an alias named after the table, so searches keep working throughout. Posts
+        written while the new index is being filled are caught up after the swap.
+
+        :return: A tuple containing the number of documents sent and the number rejected
+        :rtype: Tuple[int, int]
         """
-        for obj in session._changes["add"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["update"]:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["delete"]:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        if current_app.search_backend is None:
+            return 0, 0
+        return current_app.search_backend.reindex(cls, chunk_size, workers, swap, progress)
+
+    @classmethod
+    def create_search_tables(cls, target, connection: Connection, **kw) -> None:
+        """Creates database full-text tables alongside the rest of the schema"""
+        create_search_tables(connection, cls.__subclasses__())
 
     @classmethod
-    def reindex(cls):
-        """Indexes or re-indexes all objects in cls"""
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def drop_search_tables(cls, target, connection: Connection, **kw) -> None:
+        """Drops database full-text tables alongside the rest of the schema"""
+        drop_search_tables(connection, cls.__subclasses__())
 
 
 # Register event handlers
-db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(db.Model.metadata, "after_create", SearchableMixin.create_search_tables)
+db.event.listen(db.Model.metadata, "before_drop", SearchableMixin.drop_search_tables)
+
+
+class SearchOutbox(db.Model):
+    """Durable queue of search index changes waiting to be sent to Elasticsearch"""
+
+    __tablename__ = "search_outbox"
+
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_search_outbox_available_at", "available_at", "id"),)
+
+    def __repr__(self):
+        return f"<SearchOutbox {self.op} {self.index}/{self.object_id}>"
+
+
+class Translation(db.Model):
+    """Persistent tier of the translation cache, shared by every process"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    text_hash = db.Column(db.String(64), nullable=False)
+    source_language = db.Column(db.String(5), nullable=False)
+    dest_language = db.Column(db.String(5), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index(
+            "ix_translation_text_hash_languages",
+            "text_hash",
+            "source_language",
+            "dest_language",
+            unique=True,
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Translation {self.source_language}->{self.dest_language} {self.text_hash[:8]}>"
 
 
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
+)
+
+
+# Materialized home timelines: one row per (reader, post), filled on write
+timeline = db.Table(
+    "timeline",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("timestamp", db.DateTime, nullable=False),
+    db.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp", "post_id"),
 )
 
 
@@ -86,6 +267,8 @@ class User(UserMixin, db.Model):
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # Locale the user last signed in with, used for email sent outside of their requests
+    locale = db.Column(db.String(5))
     followed = db.relationship(
         "User",
         secondary=followers,
@@ -94,6 +277,9 @@ class User(UserMixin, db.Model):
         backref=db.backref("followers", lazy="dynamic"),
         lazy="dynamic",
     )
+    # Denormalized sizes of `followers` and `followed`, maintained by follow() and unfollow()
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return f"<User {self.username}>"
@@ -108,17 +294,62 @@ class User(UserMixin, db.Model):
 
     def avatar(self, size: Union[str, int]) -> str:
         """Returns the URL for a user's Gravatar image"""
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=retro&s={size}"
+        return gravatar_url(self.email, size)
+
+    @staticmethod
+    def avatars(users: Iterable["User"], size: Union[str, int]) -> Dict[int, str]:
+        """Returns the Gravatar URLs of many users at one size, hashing each address once
+
+        :param users: Users to build URLs for, e.g. the authors of a page of posts
+        :type users: Iterable[User]
+        :param size: Image size in pixels
+        :type size: Union[str, int]
+
+        :return: The URLs keyed by user id
+        :rtype: Dict[int, str]
+        """
+        return {user.id: user.avatar(size) for user in {user.id: user for user in users}.values()}
+
+    def is_fanned_out(self) -> bool:
+        """Indicates whether the user's posts are pushed into follower timelines on write. Users
+        with more followers than TIMELINE_FANOUT_LIMIT are read on demand instead.
+        """
+        limit = current_app.config["TIMELINE_FANOUT_LIMIT"]
+        return limit is None or self.follower_count <= limit
+
+    @staticmethod
+    def followed_by(user) -> ColumnElement:
+        """SQL expression that is true for user rows followed by `user`, so the following state can
+        be fetched in the same query as the user itself
+        """
+        return db.exists().where(
+            db.and_(followers.c.follower_id == user.id, followers.c.followed_id == User.id)
+        )
 
     def is_following(self, user) -> bool:
         """Indicates whether user is in the parent object's `followed` list"""
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return db.session.query(
+            db.exists().where(
+                db.and_(followers.c.follower_id == self.id, followers.c.followed_id == user.id)
+            )
+        ).scalar()
 
     def follow(self, user) -> None:
         """Adds user to parent object's `followed` list"""
         if not self.is_following(user):
+            fanned_out = user.is_fanned_out()
             self.followed.append(user)
+            self.following_count = User.following_count + 1
+            user.follower_count = User.follower_count + 1
+            if user.id != self.id and fanned_out:
+                db.session.execute(
+                    timeline.insert().from_select(
+                        ["user_id", "post_id", "timestamp"],
+                        db.select([db.literal(self.id), Post.id, Post.timestamp]).where(
+                            Post.user_id == user.id
+                        ),
+                    )
+                )
 
     def unfollow(self, user) -> None:
         """Removes user from parent object's `followed` list"""
@@ -126,14 +357,100 @@ class User(UserMixin, db.Model):
             self.followed.remove(user)
         except ValueError:
             pass
+        else:
+            self.following_count = User.following_count - 1
+            user.follower_count = User.follower_count - 1
+            if user.id != self.id:
+                db.session.execute(
+                    timeline.delete().where(
+                        db.and_(
+                            timeline.c.user_id == self.id,
+                            timeline.c.post_id.in_(
+                                db.select([Post.id]).where(Post.user_id == user.id)
+                            ),
+                        )
+                    )
+                )
+
+    def followed_posts(self) -> BaseQuery:
+        """Fetches posts from the parent object's materialized timeline. In hybrid mode (when
+        TIMELINE_FANOUT_LIMIT is set), posts by followed users above the limit are merged in at
+        read time.
+        """
+        posts = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id
+        )
+        limit = current_app.config["TIMELINE_FANOUT_LIMIT"]
+        if limit is None:
+            return posts.order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        pulled = Post.query.filter(
+            Post.user_id.in_(
+                self.followed.filter(User.follower_count > limit).with_entities(User.id)
+            )
+        )
+        return posts.union(pulled).order_by(Post.timestamp.desc(), Post.id.desc())
 
-    def followed_posts(self):
-        """Fetches posts written by users in the parent object's `followed` list"""
-        followed = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
-            followers.c.follower_id == self.id
+    def followed_posts_keys(self) -> Tuple[db.Column, db.Column]:
+        """Returns the (timestamp, id) columns that followed_posts() is ordered by, for keyset
+        pagination
+        """
+        if current_app.config["TIMELINE_FANOUT_LIMIT"] is None:
+            return timeline.c.timestamp, timeline.c.post_id
+        return Post.timestamp, Post.id
+
+    @staticmethod
+    def rebuild_timelines(user: Optional["User"] = None) -> None:
+        """Rebuilds materialized timelines from the followers table, for one user or for everyone.
+        Authors above TIMELINE_FANOUT_LIMIT are skipped, since their posts are read on demand.
+
+        :param user: User whose timeline should be rebuilt, defaults to all users
+        :type user: Optional[User]
+        """
+        own = db.select([Post.user_id, Post.id, Post.timestamp])
+        followed = (
+            db.select([followers.c.follower_id, Post.id, Post.timestamp])
+            .select_from(followers.join(Post.__table__, followers.c.followed_id == Post.user_id))
+            .where(followers.c.follower_id != Post.user_id)
+            .distinct()
+        )
+        limit = current_app.config["TIMELINE_FANOUT_LIMIT"]
+        if limit is not None:
+            followed = followed.where(
+                Post.user_id.notin_(db.select([User.id]).where(User.follower_count > limit))
+            )
+        clear = timeline.delete()
+        if user is not None:
+            own = own.where(Post.user_id == user.id)
+            followed = followed.where(followers.c.follower_id == user.id)
+            clear = clear.where(timeline.c.user_id == user.id)
+
+        columns = ["user_id", "post_id", "timestamp"]
+        db.session.execute(clear)
+        db.session.execute(timeline.insert().from_select(columns, own))
+        db.session.execute(timeline.insert().from_select(columns, followed))
+
+    @staticmethod
+    def reconcile_follow_counts() -> int:
+        """Recomputes follower_count and following_count from the followers table for users whose
+        counters have drifted
+
+        :return: Number of users corrected
+        :rtype: int
+        """
+        actual_followers = (
+            db.select([db.func.count()]).where(followers.c.followed_id == User.id).as_scalar()
+        )
+        actual_following = (
+            db.select([db.func.count()]).where(followers.c.follower_id == User.id).as_scalar()
+        )
+        return User.query.filter(
+            db.or_(
+                User.follower_count != actual_followers, User.following_count != actual_following
+            )
+        ).update(
+            {User.follower_count: actual_followers, User.following_count: actual_following},
+            synchronize_session=False,
         )
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
 
     def get_reset_password_token(self, expires_in: int = 600) -> str:
         """Provides a password reset token for a given user.
@@ -183,6 +500,8 @@ class Post(SearchableMixin, db.Model):
     """SQLAlchemy model for blog posts"""
 
     __searchable__ = ["body"]
+    __search_eager__ = ["author"]
+    __table_args__ = (db.Index("ix_post_user_id_timestamp", "user_id", "timestamp"),)
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -192,3 +511,55 @@ class Post(SearchableMixin, db.Model):
 
     def __repr__(self):
         return f"<Post {self.body}>"
+
+    @classmethod
+    def latest(cls, *criteria: ColumnElement) -> Optional[Tuple[int, datetime, Optional[str]]]:
+        """Returns the id, timestamp and language of the newest post matching the criteria, from
+        the timestamp indexes alone. Used to tell whether a listing of posts has changed.
+        """
+        return (
+            db.session.query(cls.id, cls.timestamp, cls.language)
+            .filter(*criteria)
+            .order_by(cls.timestamp.desc(), cls.id.desc())
+            .first()
+        )
+
+    @classmethod
+    def fan_out(cls, session: Session, flush_context) -> None:
+        """Fans newly written posts out to the timelines of their author and, unless the author is
+        above TIMELINE_FANOUT_LIMIT, their followers
+        """
+        connection = session.connection()
+        for obj in session.new:
+            if not isinstance(obj, cls):
+                continue
+            connection.execute(
+                timeline.insert().values(
+                    user_id=obj.user_id, post_id=obj.id, timestamp=obj.timestamp
+                )
+            )
+            limit = current_app.config["TIMELINE_FANOUT_LIMIT"]
+            if limit is not None:
+                count = connection.execute(
+                    db.select([User.follower_count]).where(User.id == obj.user_id)
+                ).scalar()
+                if count > limit:
+                    continue
+            connection.execute(
+                timeline.insert().from_select(
+                    ["user_id", "post_id", "timestamp"],
+                    db.select(
+                        [
+                            followers.c.follower_id,
+                            db.literal(obj.id),
+                            db.literal(obj.timestamp, db.DateTime),
+                        ]
+                    )
+                    .where(followers.c.followed_id == obj.user_id)
+                    .where(followers.c.follower_id != obj.user_id)
+                    .distinct(),
+                )
+            )
+
+
+db.event.listen(db.session, "after_flush", Post.fan_out)
@@ -0,0 +1,148 @@
+"""
+app/pagination.py
+"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy.sql import ColumnElement
+
+from . import db
+
+
+Cursor = Tuple[datetime, int]
+
+
+def encode_cursor(timestamp: datetime, id: int) -> str:
+    """Packs a (timestamp, id) position into an opaque, URL-safe cursor string"""
+    raw = f"{timestamp.isoformat()}|{id}".encode("utf-8")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Unpacks a cursor produced by encode_cursor. Raises ValueError if the cursor is malformed, so
+    it can be used directly as a `type` for `request.args.get`.
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    timestamp, _, id = urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").partition("|")
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+def encode_sort_values(values: List[Any]) -> str:
+    """Packs the sort values of a search hit into an opaque, URL-safe cursor string"""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_sort_values(cursor: str) -> List[Any]:
+    """Unpacks a cursor produced by encode_sort_values. Like decode_cursor, raises ValueError if
+    the cursor is malformed.
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    values = json.loads(urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError(f"Invalid search cursor: {cursor}")
+    return values
+
+
+class KeysetPagination:
+    """A page of results fetched by keyset pagination. Unlike flask_sqlalchemy.Pagination, there is
+    no total and no page number, only cursors pointing to the neighbouring pages.
+    """
+
+    def __init__(self, items: List[Any], has_next: bool, has_prev: bool):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """Cursor for the page of older items, to be passed back as `before`"""
+        if not self.has_next:
+            return None
+        return encode_cursor(self.items[-1].timestamp, self.items[-1].id)
+
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        """Cursor for the page of newer items, to be passed back as `after`"""
+        if not self.has_prev:
+            return None
+        return encode_cursor(self.items[0].timestamp, self.items[0].id)
+
+
+def keyset_paginate(
+    query: BaseQuery,
+    per_page: int,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+    keys: Optional[Tuple[ColumnElement, ColumnElement]] = None,
+) -> KeysetPagination:
+    """Fetches one page of a newest-first listing by seeking on (timestamp, id) rather than using
+    OFFSET, so every page costs the same as the first and no COUNT query is issued.
+
+    :param query: Query to paginate; any existing ORDER BY is replaced
+    :type query: BaseQuery
+    :param per_page: Number of items per page
+    :type per_page: int
+    :param before: Position to fetch older items from, defaults to the newest items
+    :type before: Optional[Cursor]
+    :param after: Position to fetch newer items from, takes precedence over `before`
+    :type after: Optional[Cursor]
+    :param keys: (timestamp, id) columns to seek on, defaults to (Post.timestamp, Post.id)
+    :type keys: Optional[Tuple[ColumnElement, ColumnElement]]
+
+    :return: The requested page
+    :rtype: KeysetPagination
+    """
+    if keys is None:
+        from .models import Post
+
+        keys = (Post.timestamp, Post.id)
+    timestamp, id = keys
+    query = query.order_by(None)
+
+    if after is not None:
+        rows = (
+            query.filter(db.tuple_(timestamp, id) > after)
+            .order_by(timestamp.asc(), id.asc())
+            .limit(per_page + 1)
+            .all()
+        )
+        return KeysetPagination(rows[:per_page][::-1], True, len(rows) > per_page)
+
+    if before is not None:
+        query = query.filter(db.tuple_(timestamp, id) < before)
+    rows = query.order_by(timestamp.desc(), id.desc()).limit(per_page + 1).all()
+    return KeysetPagination(rows[:per_page], len(rows) > per_page, before is not None)
+
+
+class SearchPagination(KeysetPagination):
+    """A page of search results, ordered by relevance. The cursors carry the search backend's sort
+    values for the first and last hit, to be passed back as `after` and `before` like the cursors
+    of a KeysetPagination.
+    """
+
+    def __init__(
+        self, items: List[Any], sort_values: List[List[Any]], has_next: bool, has_prev: bool
+    ):
+        super().__init__(items, has_next, has_prev)
+        # Hits whose rows are gone from the database still position the cursors
+        self.sort_values = sort_values
+        self.has_next = has_next and bool(sort_values)
+        self.has_prev = has_prev and bool(sort_values)
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        """Cursor for the page of less relevant results, to be passed back as `before`"""
+        if not self.has_next:
+            return None
+        return encode_sort_values(self.sort_values[-1])
+
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        """Cursor for the page of more relevant results, to be passed back as `after`"""
+        if not self.has_prev:
+            return None
+        return encode_sort_values(self.sort_values[0])
@@ -0,0 +1,94 @@
+"""
+app/pool.py
+"""
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+from weakref import WeakSet
+
+from flask import Flask
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+
+#: Every engine created by the app, so that forked processes can drop the pools they inherit
+_engines: "WeakSet[Engine]" = WeakSet()
+#: Pools replaced after a fork, kept referenced so that garbage collection does not close them
+_inherited_pools: List[Pool] = []
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection, including the time
+    spent opening one when the pool had to grow
+    """
+
+    #: Called with the wait of every checkout, in seconds
+    observe: Optional[Callable[[float], None]] = None
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.observe is not None:
+                self.observe(perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.observe = self.observe
+        return pool
+
+
+def apply_pool_options(app: Flask, options: Dict[str, Any]) -> None:
+    """Sizes the pool of an engine from the DATABASE_POOL_* settings. SQLite engines, which
+    Flask-SQLAlchemy gives a NullPool or StaticPool, are left alone.
+
+    :param app: App the engine belongs to
+    :type app: Flask
+    :param options: Keyword arguments of `create_engine`, updated in place
+    :type options: Dict[str, Any]
+    """
+    if "poolclass" in options:
+        return
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=app.config["DATABASE_POOL_SIZE"],
+        max_overflow=app.config["DATABASE_MAX_OVERFLOW"],
+        pool_timeout=app.config["DATABASE_POOL_TIMEOUT"],
+        pool_recycle=app.config["DATABASE_POOL_RECYCLE"],
+        pool_pre_ping=app.config["DATABASE_POOL_PRE_PING"],
+    )
+
+
+def track(engine: Engine) -> Engine:
+    """Registers an engine, so that a forked child process does not reuse its connections"""
+    _engines.add(engine)
+    return engine
+
+
+def discard_inherited_connections() -> None:
+    """Gives every engine a fresh pool in a newly forked process. Called by the gunicorn post_fork
+    hook, since workers of a preloaded app inherit the master's engines.
+
+    As with Engine.dispose(close=False) from SQLAlchemy 1.4 on, the inherited connections are set
+    aside without being closed, since closing them would also end the parent's sessions on the
+    shared sockets.
+    """
+    for engine in list(_engines):
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+
+
+def pool_gauges(engines: Dict[str, Engine]) -> Dict[str, float]:
+    """Returns the size, checked out and overflow connections of each engine's QueuePool, labelled
+    with the database name it is given in `engines`
+    """
+    gauges = {}
+    for database, engine in engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        label = f'{{database="{database}"}}'
+        gauges[f"microblog_db_pool_size{label}"] = pool.size()
+        gauges[f"microblog_db_pool_checked_out{label}"] = pool.checkedout()
+        gauges[f"microblog_db_pool_checked_in{label}"] = pool.checkedin()
+        gauges[f"microblog_db_pool_overflow{label}"] = max(0, pool.overflow())
+    return gauges
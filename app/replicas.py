@@ -0,0 +1,137 @@
+"""
+app/replicas.py
+"""
+import random
+from functools import wraps
+from time import time
+from typing import Callable, List, Optional
+
+from flask import current_app, Flask, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
+
+from .pool import apply_pool_options, track
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def _is_read(clause) -> bool:
+    """Whether a statement only reads, and may therefore run on a replica"""
+    if isinstance(clause, SelectBase):
+        return getattr(clause, "_for_update_arg", None) is None
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().lower().startswith("select")
+    return False
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of read-only requests to a replica, and everything else to the
+    primary. Models with a `__bind_key__` keep their own engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super().get_bind(mapper, clause)
+        if bind is not self.bind:
+            return bind
+        if self._flushing or not _is_read(clause):
+            router.wrote()
+            return bind
+        return router.replica() or bind
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions that route reads to the replicas set up by `router`, and
+    engines whose pools are sized by the DATABASE_POOL_* settings
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        apply_pool_options(app, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return track(super().create_engine(sa_url, engine_opts))
+
+
+class ReplicaRouter:
+    """Routes the database reads of GET, HEAD and OPTIONS requests to the replicas in
+    SQLALCHEMY_REPLICA_URIS, one replica per request.
+
+    A request moves to the primary for good as soon as it writes, and its user stays on the primary
+    for REPLICA_STICKY_SECONDS afterwards, so that they read their own writes despite replication
+    lag. The deadline is kept in the session cookie. Requests with other methods, and code running
+    outside of requests, always use the primary. Views that read before writing, or that must not
+    see stale data, opt out with the `use_primary` decorator.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Creates an engine per replica URI, with the same options as the primary's"""
+        from . import db
+
+        engines = app.extensions["replicas"] = []
+        for uri in app.config["SQLALCHEMY_REPLICA_URIS"]:
+            url = make_url(uri)
+            options = {}
+            db.apply_pool_defaults(app, options)
+            db.apply_driver_hacks(app, url, options)
+            options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+            engines.append(db.create_engine(url, options))
+        if engines:
+            app.before_request(self.start_request)
+            app.after_request(self.finish_request)
+
+    @staticmethod
+    def engines(app: Flask) -> List[Engine]:
+        """Returns the app's replica engines"""
+        return app.extensions["replicas"]
+
+    @staticmethod
+    def start_request() -> None:
+        """Decides whether the request may read from a replica"""
+        g.pop("db_replica", None)
+        g.db_wrote = False
+        g.db_primary = (
+            request.method not in SAFE_METHODS or session.get("db_primary_until", 0) > time()
+        )
+
+    @staticmethod
+    def finish_request(response):
+        """Keeps the user on the primary for a while after the request wrote"""
+        if g.get("db_wrote"):
+            session["db_primary_until"] = time() + current_app.config["REPLICA_STICKY_SECONDS"]
+        return response
+
+    @staticmethod
+    def replica() -> Optional[Engine]:
+        """Returns the replica the current request reads from, or None to use the primary"""
+        if not has_request_context() or g.get("db_primary", True):
+            return None
+        if "db_replica" not in g:
+            g.db_replica = random.choice(current_app.extensions["replicas"])
+        return g.db_replica
+
+    @staticmethod
+    def wrote() -> None:
+        """Moves the current request, and its user's next requests, to the primary"""
+        if has_request_context() and current_app.extensions["replicas"]:
+            g.db_primary = g.db_wrote = True
+
+
+router = ReplicaRouter()
+
+
+def use_primary(view: Callable) -> Callable:
+    """View decorator that reads from the primary, for views that write or need fresh data"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_primary = True
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -1,55 +1,539 @@
 """
 app/search.py
 """
-from typing import List, Tuple
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-from flask import current_app
+from flask import current_app, Flask
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.url import make_url
 
 from . import db
+from .instrumentation import outbound_http
+
+
+Documents = Dict[int, Optional[Dict[str, Any]]]
+Progress = Callable[[int, float], None]
+#: Matching document IDs, each with the sort values that locate it in the ranking
+Hits = List[Tuple[int, List[Any]]]
+
+
+def payload_for(model: db.Model) -> Dict[str, Any]:
+    """Builds the document stored in the search index for a database entry"""
+    return {field: getattr(model, field) for field in model.__searchable__}
+
+
+class SearchBackend(ABC):
+    """Interface shared by the full-text search backends"""
+
+    #: Whether changes are applied inside the committing transaction, rather than queued in the
+    #: search outbox for the background indexer
+    transactional = False
+
+    @abstractmethod
+    def bulk_index(
+        self, index: str, documents: Documents, connection: Optional[Connection] = None
+    ) -> List[int]:
+        """Indexes and deletes many documents at once
+
+        :param index: Name of the index, which is the model's table name
+        :type index: str
+        :param documents: Mapping of document ID to its payload, or to None to delete the document
+        :type documents: Documents
+        :param connection: Connection whose transaction the change belongs to, for transactional
+            backends
+        :type connection: Optional[Connection]
+
+        :return: IDs of the documents that the backend rejected
+        :rtype: List[int]
+        """
+
+    @abstractmethod
+    def query_index(
+        self,
+        index: str,
+        query: str,
+        limit: int,
+        search_after: Optional[List[Any]] = None,
+        ascending: bool = False,
+    ) -> Hits:
+        """Searches an index, ranking matches by relevance and then by ID
+
+        :param index: Name of the index
+        :type index: str
+        :param query: Query string to search
+        :type query: str
+        :param limit: Maximum number of hits to return
+        :type limit: int
+        :param search_after: Sort values of a previous hit; only hits ranked after it are returned
+        :type search_after: Optional[List[Any]]
+        :param ascending: Whether to walk the ranking from least to most relevant
+        :type ascending: bool
+
+        :return: Matching IDs with their sort values, in the requested order
+        :rtype: Hits
+        """
+
+    @abstractmethod
+    def reindex(
+        self, model, chunk_size: int, workers: int, swap: bool, progress: Optional[Progress]
+    ) -> Tuple[int, int]:
+        """Rebuilds the index for a searchable model from the database
+
+        :return: A tuple containing the number of documents sent and the number rejected
+        :rtype: Tuple[int, int]
+        """
+
+
+class ElasticsearchBackend(SearchBackend):
+    """Search backed by the app's Elasticsearch client. Changes go through the search outbox.
+
+    Documents also store their ID in an `id` field, which is the tiebreaker for search_after since
+    Elasticsearch cannot sort on `_id` efficiently.
+    """
+
+    def bulk_index(
+        self, index: str, documents: Documents, connection: Optional[Connection] = None
+    ) -> List[int]:
+        if not documents:
+            return []
+        body: List[Dict[str, Any]] = []
+        for id, payload in documents.items():
+            if payload is None:
+                body.append({"delete": {"_index": index, "_id": id}})
+            else:
+                body.append({"index": {"_index": index, "_id": id}})
+                body.append({**payload, "id": id})
+        with outbound_http():
+            response = current_app.elasticsearch.bulk(body=body)
+        if not response["errors"]:
+            return []
+        # Deleting a document that is already gone is reported as a 404 without an error
+        return [
+            int(result["_id"])
+            for item in response["items"]
+            for result in item.values()
+            if "error" in result
+        ]
+
+    def query_index(
+        self,
+        index: str,
+        query: str,
+        limit: int,
+        search_after: Optional[List[Any]] = None,
+        ascending: bool = False,
+    ) -> Hits:
+        order = "asc" if ascending else "desc"
+        body: Dict[str, Any] = {
+            "query": {"multi_match": {"query": query, "fields": ["*"], "lenient": True}},
+            "size": limit,
+            "sort": [
+                {"_score": order},
+                {"id": {"order": order, "unmapped_type": "long"}},
+            ],
+            "_source": False,
+            "track_total_hits": False,
+        }
+        if search_after is not None:
+            body["search_after"] = search_after
+        with outbound_http():
+            search = current_app.elasticsearch.search(index=index, body=body)
+        return [(int(hit["_id"]), hit["sort"]) for hit in search["hits"]["hits"]]
+
+    def reindex(
+        self, model, chunk_size: int, workers: int, swap: bool, progress: Optional[Progress]
+    ) -> Tuple[int, int]:
+        alias = model.__tablename__
+        if not swap:
+            return self.bulk_stream(alias, model.stream_documents(chunk_size), workers, progress)
+
+        index = self.create_index(alias)
+        last_id = [0]
+
+        def chunks(after_id: int) -> Iterable[Dict[int, Dict[str, Any]]]:
+            for chunk in model.stream_documents(chunk_size, after_id):
+                last_id[0] = max(chunk)
+                yield chunk
+
+        sent, failed = self.bulk_stream(index, chunks(0), workers, progress)
+        self.swap_alias(alias, index)
+        # Catch up on rows written while the new index was being filled
+        caught_up, caught_up_failed = self.bulk_stream(alias, chunks(last_id[0]), workers)
+        return sent + caught_up, failed + caught_up_failed
+
+    def bulk_stream(
+        self,
+        index: str,
+        chunks: Iterable[Dict[int, Dict[str, Any]]],
+        workers: int = 4,
+        progress: Optional[Progress] = None,
+    ) -> Tuple[int, int]:
+        """Sends chunks of documents as parallel bulk requests. At most two chunks per worker are
+        in flight, so memory stays bounded however many documents are streamed.
+
+        :param index: Name of the Elasticsearch index to write to
+        :type index: str
+        :param chunks: Iterable of {document ID: payload} mappings, one bulk request each
+        :type chunks: Iterable[Dict[int, Dict[str, Any]]]
+        :param workers: Number of concurrent bulk requests, defaults to 4
+        :type workers: int
+        :param progress: Called with the number of documents sent so far and the elapsed seconds
+        :type progress: Optional[Progress]
+
+        :return: A tuple containing the number of documents sent and the number rejected
+        :rtype: Tuple[int, int]
+        """
+        app = current_app._get_current_object()
+
+        def send(chunk: Dict[int, Dict[str, Any]]) -> Tuple[int, int]:
+            with app.app_context():
+                return len(chunk), len(self.bulk_index(index, chunk))
+
+        sent = failed = 0
+        start = perf_counter()
+        pending: Set[Future] = set()
+
+        def collect(done: Set[Future]) -> None:
+            nonlocal sent, failed
+            for future in done:
+                count, rejected = future.result()
+                sent += count
+                failed += rejected
+            if progress and done:
+                progress(sent, perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunks:
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(send, chunk))
+            collect(wait(pending).done)
+        return sent, failed
+
+    @staticmethod
+    def create_index(alias: str) -> str:
+        """Creates a new, timestamped index to be swapped in behind an alias later. Refreshes and
+        replicas are disabled while it is being filled.
+
+        :return: Name of the new index
+        :rtype: str
+        """
+        name = f"{alias}-{datetime.utcnow():%Y%m%d%H%M%S}"
+        current_app.elasticsearch.indices.create(
+            index=name, body={"settings": {"refresh_interval": "-1", "number_of_replicas": 0}}
+        )
+        return name
+
+    @staticmethod
+    def swap_alias(alias: str, index: str, delete_old: bool = True) -> List[str]:
+        """Atomically points an alias at a freshly built index. A concrete index that has the
+        alias's name (from before aliases were used) is removed in the same operation.
+
+        :param alias: Name that searches and updates use, i.e. the model's table name
+        :type alias: str
+        :param index: Index created by create_index and filled with documents
+        :type index: str
+        :param delete_old: Whether to delete the indices the alias pointed at before, defaults to
+            True
+        :type delete_old: bool
+
+        :return: Names of the indices the alias pointed at before
+        :rtype: List[str]
+        """
+        es = current_app.elasticsearch
+        es.indices.put_settings(
+            index=index, body={"index": {"refresh_interval": None, "number_of_replicas": None}}
+        )
+        es.indices.refresh(index=index)
+
+        actions: List[Dict[str, Any]] = [{"add": {"index": index, "alias": alias}}]
+        old: List[str] = []
+        if es.indices.exists_alias(name=alias):
+            old = list(es.indices.get_alias(name=alias))
+            actions[:0] = [{"remove": {"index": name, "alias": alias}} for name in old]
+        elif es.indices.exists(index=alias):
+            actions.insert(0, {"remove_index": {"index": alias}})
+        es.indices.update_aliases(body={"actions": actions})
+
+        if delete_old:
+            for name in old:
+                es.indices.delete(index=name)
+        return old
+
+
+class DatabaseBackend(SearchBackend):
+    """Search backed by the database's own full-text index, kept in a `<table>_fts` table that is
+    updated in the same transaction as the rows it indexes
+    """
+
+    transactional = True
+    #: Column of the full-text table holding the indexed row's ID
+    id_column = "id"
+
+    def bulk_index(
+        self, index: str, documents: Documents, connection: Optional[Connection] = None
+    ) -> List[int]:
+        if not documents:
+            return []
+        connection = connection or db.session.connection()
+        connection.execute(
+            db.text(f"DELETE FROM {index}_fts WHERE {self.id_column} IN :ids").bindparams(
+                db.bindparam("ids", expanding=True)
+            ),
+            ids=list(documents),
+        )
+        rows = [
+            {**self.params(), **payload, "id": id}
+            for id, payload in documents.items()
+            if payload is not None
+        ]
+        if rows:
+            fields = [field for field in documents[rows[0]["id"]]]
+            connection.execute(db.text(self.insert_statement(index, fields)), rows)
+        return []
+
+    def reindex(
+        self, model, chunk_size: int, workers: int, swap: bool, progress: Optional[Progress]
+    ) -> Tuple[int, int]:
+        index, fields = model.__tablename__, model.__searchable__
+        start = perf_counter()
+        db.session.execute(db.text(f"DELETE FROM {index}_fts"))
+        sent = db.session.execute(
+            db.text(self.rebuild_statement(index, fields)), self.params()
+        ).rowcount
+        db.session.commit()
+        if progress:
+            progress(sent, perf_counter() - start)
+        return sent, 0
+
+    def params(self) -> Dict[str, Any]:
+        """Extra bind parameters used by the insert and rebuild statements"""
+        return {}
+
+    @staticmethod
+    def seek(
+        score: str, id: str, search_after: Optional[List[Any]], ascending: bool
+    ) -> Tuple[str, str]:
+        """Builds the keyset condition and ORDER BY clause for a (score, id) ranking
+
+        :return: A tuple containing the condition, empty for the first page, and the ORDER BY
+        :rtype: Tuple[str, str]
+        """
+        operator, order = (">", "ASC") if ascending else ("<", "DESC")
+        condition = f"AND ({score}, {id}) {operator} (:score, :id) " if search_after else ""
+        return condition, f"ORDER BY {score} {order}, {id} {order}"
+
+    @abstractmethod
+    def insert_statement(self, index: str, fields: List[str]) -> str:
+        """INSERT statement for one document, with the ID bound as :id and fields by name"""
+
+    @abstractmethod
+    def rebuild_statement(self, index: str, fields: List[str]) -> str:
+        """INSERT ... SELECT statement that indexes every row of the model's table"""
+
+    @staticmethod
+    @abstractmethod
+    def create_ddl(index: str, fields: List[str]) -> List[str]:
+        """Statements that create the full-text table for a searchable model"""
+
+
+class SQLiteBackend(DatabaseBackend):
+    """SQLite FTS5 virtual table, ranked by bm25"""
+
+    id_column = "rowid"
+
+    def insert_statement(self, index: str, fields: List[str]) -> str:
+        columns = ", ".join(fields)
+        values = ", ".join(f":{field}" for field in fields)
+        return f"INSERT INTO {index}_fts (rowid, {columns}) VALUES (:id, {values})"
+
+    def rebuild_statement(self, index: str, fields: List[str]) -> str:
+        columns = ", ".join(fields)
+        return f"INSERT INTO {index}_fts (rowid, {columns}) SELECT id, {columns} FROM {index}"
+
+    def query_index(
+        self,
+        index: str,
+        query: str,
+        limit: int,
+        search_after: Optional[List[Any]] = None,
+        ascending: bool = False,
+    ) -> Hits:
+        # Quote every term so that user input is never parsed as FTS5 query syntax
+        terms = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+        if not terms:
+            return []
+        # bm25 ranks are negative, with the best match lowest
+        condition, order_by = self.seek("-rank", "rowid", search_after, ascending)
+        score, id = search_after or (None, None)
+        rows = db.session.execute(
+            db.text(
+                f"SELECT rowid, -rank FROM {index}_fts WHERE {index}_fts MATCH :terms "
+                f"{condition}{order_by} LIMIT :limit"
+            ),
+            {"terms": terms, "score": score, "id": id, "limit": limit},
+        )
+        return [(row[0], [row[1], row[0]]) for row in rows]
+
+    @staticmethod
+    def create_ddl(index: str, fields: List[str]) -> List[str]:
+        return [f"CREATE VIRTUAL TABLE IF NOT EXISTS {index}_fts USING fts5({', '.join(fields)})"]
+
+
+class PostgresBackend(DatabaseBackend):
+    """PostgreSQL tsvector column with a GIN index, ranked by ts_rank. The text search
+    configuration is set by SEARCH_TEXT_CONFIG.
+    """
+
+    def params(self) -> Dict[str, Any]:
+        return {"config": current_app.config["SEARCH_TEXT_CONFIG"]}
+
+    @staticmethod
+    def document(fields: List[str], prefix: str = "") -> str:
+        text = " || ' ' || ".join(f"coalesce({prefix}{field}, '')" for field in fields)
+        return f"to_tsvector(CAST(:config AS regconfig), {text})"
+
+    def insert_statement(self, index: str, fields: List[str]) -> str:
+        document = self.document(fields, ":")
+        return f"INSERT INTO {index}_fts (id, document) VALUES (:id, {document})"
+
+    def rebuild_statement(self, index: str, fields: List[str]) -> str:
+        document = self.document(fields)
+        return f"INSERT INTO {index}_fts (id, document) SELECT id, {document} FROM {index}"
+
+    def query_index(
+        self,
+        index: str,
+        query: str,
+        limit: int,
+        search_after: Optional[List[Any]] = None,
+        ascending: bool = False,
+    ) -> Hits:
+        condition, order_by = self.seek("rank", "id", search_after, ascending)
+        score, id = search_after or (None, None)
+        # ts_rank returns a real, which would be widened to double precision when compared with
+        # the cursor's score and never equal it, so ties would repeat or be skipped across pages.
+        # Ranking by the double itself makes the cursor carry the exact value compared against.
+        rows = db.session.execute(
+            db.text(
+                "SELECT id, rank FROM ("
+                "SELECT id, CAST(ts_rank(document, q) AS double precision) AS rank "
+                f"FROM {index}_fts, "
+                "plainto_tsquery(CAST(:config AS regconfig), :query) AS q WHERE document @@ q"
+                f") AS hits WHERE true {condition}{order_by} LIMIT :limit"
+            ),
+            {**self.params(), "query": query, "score": score, "id": id, "limit": limit},
+        )
+        return [(row[0], [row[1], row[0]]) for row in rows]
+
+    @staticmethod
+    def create_ddl(index: str, fields: List[str]) -> List[str]:
+        return [
+            f"CREATE TABLE IF NOT EXISTS {index}_fts "
+            "(id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)",
+            f"CREATE INDEX IF NOT EXISTS ix_{index}_fts_document ON {index}_fts "
+            "USING GIN (document)",
+        ]
+
+
+DATABASE_BACKENDS = {"sqlite": SQLiteBackend, "postgresql": PostgresBackend}
+
+
+def create_backend(app: Flask) -> Optional[SearchBackend]:
+    """Picks the search backend named by SEARCH_BACKEND: "elasticsearch", "database" or "none".
+    Defaults to Elasticsearch when ELASTICSEARCH_URL is set and to the database otherwise.
+    """
+    name = app.config["SEARCH_BACKEND"] or ("elasticsearch" if app.elasticsearch else "database")
+    if name == "elasticsearch":
+        return ElasticsearchBackend() if app.elasticsearch else None
+    if name == "database":
+        dialect = make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name()
+        backend = DATABASE_BACKENDS.get(dialect)
+        if backend is None:
+            app.logger.warning(f"No full-text search support for {dialect}, search is disabled")
+            return None
+        return backend()
+    return None
+
+
+def create_search_tables(connection: Connection, models: Iterable) -> None:
+    """Creates the database full-text tables for searchable models, where the dialect has them"""
+    backend = DATABASE_BACKENDS.get(connection.dialect.name)
+    if backend is None:
+        return
+    for model in models:
+        for statement in backend.create_ddl(model.__tablename__, model.__searchable__):
+            connection.execute(db.text(statement))
+
+
+def drop_search_tables(connection: Connection, models: Iterable) -> None:
+    """Drops the tables created by create_search_tables"""
+    if connection.dialect.name not in DATABASE_BACKENDS:
+        return
+    for model in models:
+        connection.execute(db.text(f"DROP TABLE IF EXISTS {model.__tablename__}_fts"))
 
 
 def add_to_index(index: str, model: db.Model) -> None:
-    """Add a database entry to a given Elasticsearch index"""
+    """Add a database entry to a given search index"""
 
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.search_backend.bulk_index(index, {model.id: payload_for(model)})
 
 
 def remove_from_index(index: str, model: db.Model) -> None:
-    """Remove a database entry from a given Elasticsearch index"""
+    """Remove a database entry from a given search index"""
 
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.bulk_index(index, {model.id: None})
+
+
+def bulk_index(index: str, documents: Documents) -> List[int]:
+    """Indexes and deletes many documents with a single request to the search backend
+
+    :param index: Name of the search index
+    :type index: str
+    :param documents: Mapping of document ID to its payload, or to None to delete the document
+    :type documents: Documents
+
+    :return: IDs of the documents that the backend rejected
+    :rtype: List[int]
+    """
+    if not current_app.search_backend:
+        return []
+    return current_app.search_backend.bulk_index(index, documents)
 
 
-def query_index(index: str, query: str, page: int, per_page: int) -> Tuple[List[int], int]:
-    """Searches a given Elasticsearch index for a provided query
-    :param index: Name of the Elasticsearch index to search
+def query_index(
+    index: str,
+    query: str,
+    limit: int,
+    search_after: Optional[List[Any]] = None,
+    ascending: bool = False,
+) -> Hits:
+    """Searches a given index for a provided query, paginating with search_after rather than an
+    offset so that deep pages cost the same as the first one
+    :param index: Name of the search index
     :type index: str
     :param query: Query string to search
     :type query: str
-    :param page: Results page number
-    :type page: int
-    :param per_page: Number of results provided per page
-    :type per_page: int
+    :param limit: Maximum number of hits to return
+    :type limit: int
+    :param search_after: Sort values of the hit to continue from, defaults to the best match
+    :type search_after: Optional[List[Any]]
+    :param ascending: Whether to walk the ranking backwards, towards the best match
+    :type ascending: bool
 
-    :return: A tuple containing the IDs of the hits and the total number of results
-    :rtype: Tuple[List[int], int]
+    :return: The IDs of the hits, each with the sort values to continue from
+    :rtype: Hits
     """
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={
-            "query": {"multi_match": {"query": query, "fields": ["*"]}},
-            "from": (page - 1) * per_page,
-            "size": per_page,
-        },
-    )
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
+    if not current_app.search_backend:
+        return []
+    return current_app.search_backend.query_index(index, query, limit, search_after, ascending)
@@ -1,13 +1,32 @@
-function translate(sourceElem, destElem, sourceLang, destLang) {
-    $(destElem).html("<img src='{{ url_for("static", filename="img/loading.gif") }}'>");
+// app/templates/js/translate.js
+function translatePosts(postIds, destLang) {
+    var loading = "<img src='{{ url_for("static", filename="img/loading.gif") }}'>";
+    $.each(postIds, function(i, id) {
+        $("#translation" + id).removeAttr("data-post-id").html(loading);
+    });
 
-    $.post("/translate", {
-        text: $(sourceElem).text(),
-        source_language: sourceLang,
-        dest_language: destLang
+    // a single request translates every post, whatever its language
+    $.ajax({
+        url: "{{ url_for('main.translate_posts') }}",
+        method: "POST",
+        contentType: "application/json",
+        data: JSON.stringify({ids: postIds, dest_language: destLang})
     }).done(function(response) {
-        $(destElem).html("<em>" + response["text"] + "</em>");
+        $.each(postIds, function(i, id) {
+            $("#translation" + id).empty().append($("<em>").text(response["translations"][id]));
+        });
     }).fail(function() {
-        $(destElem).text("{{ _('Error: Could not contact server') }}");
+        $.each(postIds, function(i, id) {
+            $("#translation" + id).text("{{ _('Error: Could not contact server') }}");
+        });
     });
-}
\ No newline at end of file
+}
+
+function translateAll(destLang) {
+    var postIds = $(".translation[data-post-id]").map(function() {
+        return $(this).data("post-id");
+    }).get();
+    if (postIds.length) {
+        translatePosts(postIds, destLang);
+    }
+}
@@ -3,22 +3,340 @@ app/translate.py
 """
 
 import json
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
 
 import requests
-from flask import current_app
+from flask import current_app, Flask
 from flask_babel import _
+from requests.adapters import HTTPAdapter
+from sqlalchemy.exc import DBAPIError, IntegrityError, SQLAlchemyError
+
+from . import db
+from .cache import LRUCache
+from .instrumentation import outbound_http
+
+
+class _Tiers:
+    """The in-process tier of one app's translation cache and the counters for both tiers"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.memory = LRUCache(maxsize, ttl)
+        self.lock = Lock()
+        self.persistent_hits = 0
+        self.misses = 0
+
+
+class TranslationCache:
+    """Caches translations keyed on (text hash, source language, destination language), so that a
+    popular post is only sent to the translation service once.
+
+    Lookups go to an in-process LRU of TRANSLATION_CACHE_SIZE entries that expire after
+    TRANSLATION_CACHE_TTL seconds, then to the `translation` table shared by every process.
+    """
+
+    def init_app(self, app: Flask) -> None:
+        """Attaches a fresh in-process tier to the app"""
+        app.extensions["translation_cache"] = _Tiers(
+            app.config["TRANSLATION_CACHE_SIZE"], app.config["TRANSLATION_CACHE_TTL"]
+        )
+
+    @staticmethod
+    def _tiers() -> _Tiers:
+        return current_app.extensions["translation_cache"]
+
+    @staticmethod
+    def key(text: str, source_language: str, dest_language: str) -> Tuple[str, str, str]:
+        """Builds the cache key for a translation"""
+        return sha256(text.encode("utf-8")).hexdigest(), source_language, dest_language
+
+    def get(self, text: str, source_language: str, dest_language: str) -> Optional[str]:
+        """Returns a cached translation, or None if neither tier has it"""
+        from .models import Translation
+
+        tiers = self._tiers()
+        key = self.key(text, source_language, dest_language)
+        translation = tiers.memory.get(key)
+        if translation is not None:
+            return translation
+
+        text_hash, source_language, dest_language = key
+        translation = (
+            db.session.query(Translation.text)
+            .filter_by(
+                text_hash=text_hash, source_language=source_language, dest_language=dest_language
+            )
+            .scalar()
+        )
+        with tiers.lock:
+            if translation is None:
+                tiers.misses += 1
+            else:
+                tiers.persistent_hits += 1
+        if translation is not None:
+            tiers.memory.set(key, translation)
+        return translation
+
+    def get_many(
+        self, texts: Iterable[Tuple[str, str]], dest_language: str
+    ) -> Dict[Tuple[str, str], str]:
+        """Looks up many translations into one language, with a single query for those missing
+        from the in-process tier
+
+        :param texts: (text, source language) pairs to look up
+        :type texts: Iterable[Tuple[str, str]]
+        :param dest_language: Language to translate into
+        :type dest_language: str
+
+        :return: The cached translations, keyed by (text, source language)
+        :rtype: Dict[Tuple[str, str], str]
+        """
+        from .models import Translation
+
+        tiers = self._tiers()
+        found: Dict[Tuple[str, str], str] = {}
+        missing: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        for text, source_language in texts:
+            key = self.key(text, source_language, dest_language)
+            translation = tiers.memory.get(key)
+            if translation is None:
+                missing[key[:2]] = (text, source_language)
+            else:
+                found[text, source_language] = translation
+        if not missing:
+            return found
+
+        rows = db.session.query(
+            Translation.text_hash, Translation.source_language, Translation.text
+        ).filter(
+            Translation.text_hash.in_({text_hash for text_hash, _ in missing}),
+            Translation.dest_language == dest_language,
+        )
+        for text_hash, source_language, translation in rows:
+            item = missing.get((text_hash, source_language))
+            if item is not None:
+                found[item] = translation
+                tiers.memory.set((text_hash, source_language, dest_language), translation)
+        with tiers.lock:
+            hits = sum(1 for item in missing.values() if item in found)
+            tiers.persistent_hits += hits
+            tiers.misses += len(missing) - hits
+        return found
+
+    def set(self, text: str, source_language: str, dest_language: str, translation: str) -> None:
+        """Stores a translation in both tiers. The row is written in a transaction of its own, so
+        that the request's session is left untouched.
+        """
+        from .models import Translation
+
+        key = self.key(text, source_language, dest_language)
+        self._tiers().memory.set(key, translation)
+        text_hash, source_language, dest_language = key
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    Translation.__table__.insert(),
+                    text_hash=text_hash,
+                    source_language=source_language,
+                    dest_language=dest_language,
+                    text=translation,
+                )
+        except IntegrityError:
+            # Another process translated the same text first
+            pass
+        except (DBAPIError, SQLAlchemyError) as e:
+            current_app.logger.error(e)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit and miss counts for this process. A miss is a call to the translation
+        service.
+        """
+        tiers = self._tiers()
+        memory = tiers.memory.stats()
+        return {
+            "memory_size": memory["size"],
+            "memory_hits": memory["hits"],
+            "persistent_hits": tiers.persistent_hits,
+            "misses": tiers.misses,
+        }
+
+
+cache = TranslationCache()
+
+
+class CircuitBreaker:
+    """Fails fast once a service has failed `threshold` times in a row. After `reset_timeout`
+    seconds a single trial call is let through, which closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Returns whether a call may be made now"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Half-open: let this call through and hold the others back until it reports
+            self.opened_at = monotonic()
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = monotonic()
+
+
+class TranslatorClient:
+    """HTTP client for the Microsoft translation API. One client is shared by the whole app, so
+    connections are pooled and kept alive across requests. Every call is bounded by connect and
+    read timeouts, and a circuit breaker stops calling the service while it keeps failing.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        timeout: Tuple[float, float] = (3.05, 10),
+        pool_size: int = 10,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        :param url: Translate endpoint, which takes `text`, `from` and `to` query parameters
+        :type url: str
+        :param key: Subscription key
+        :type key: str
+        :param timeout: Connect and read timeouts in seconds, defaults to (3.05, 10)
+        :type timeout: Tuple[float, float]
+        :param pool_size: Connections kept open to the service, defaults to 10
+        :type pool_size: int
+        :param breaker: Circuit breaker, defaults to one that opens after 5 failures for 30s
+        :type breaker: Optional[CircuitBreaker]
+        """
+        self.url = url
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers["Ocp-Apim-Subscription-Key"] = key
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> Optional["TranslatorClient"]:
+        """Creates the client described by an app's config, or None without MS_TRANSLATOR_KEY"""
+        if not config.get("MS_TRANSLATOR_KEY"):
+            return None
+        return cls(
+            config["TRANSLATOR_URL"],
+            config["MS_TRANSLATOR_KEY"],
+            timeout=(config["TRANSLATOR_CONNECT_TIMEOUT"], config["TRANSLATOR_READ_TIMEOUT"]),
+            pool_size=config["TRANSLATOR_POOL_SIZE"],
+            breaker=CircuitBreaker(
+                config["TRANSLATOR_FAILURE_THRESHOLD"], config["TRANSLATOR_RESET_TIMEOUT"]
+            ),
+        )
+
+    def translate(self, text: str, source_language: str, dest_language: str) -> Optional[str]:
+        """Translates text with the service, bypassing the cache
+
+        :return: The translated text, or None if the call failed or the circuit is open
+        :rtype: Optional[str]
+        """
+        if not self.breaker.allow():
+            return None
+        try:
+            with outbound_http():
+                r = self.session.get(
+                    self.url,
+                    params={"text": text, "from": source_language, "to": dest_language},
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as e:
+            current_app.logger.warning(f"Translation request failed: {e}")
+            self.breaker.record_failure()
+            return None
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+            return None
+        # The service answered, so a client error is not a reason to stop calling it
+        self.breaker.record_success()
+        if r.status_code != 200:
+            return None
+        return json.loads(r.content.decode("utf-8-sig"))
+
+    def close(self) -> None:
+        self.session.close()
 
 
 def translate(text: str, source_language: str, dest_language: str) -> str:
-    """Issue an call to the Microsoft API to translate the provided text"""
-    if "MS_TRANSLATOR_KEY" not in current_app.config or not current_app.config["MS_TRANSLATOR_KEY"]:
+    """Translates the provided text, from the translation cache when possible"""
+    translation = cache.get(text, source_language, dest_language)
+    if translation is not None:
+        return translation
+    if current_app.translator is None:
         return _("Error: the translation service is not configured.")
-    auth = {"Ocp-Apim-Subscription-Key": current_app.config["MS_TRANSLATOR_KEY"]}
-    r = requests.get(
-        f"https://api.microsofttranslator.com/v2/Ajax.svc/Translate?text={text}"
-        f"&from={source_language}&to={dest_language}",
-        headers=auth,
-    )
-    if r.status_code != 200:
+    translation = current_app.translator.translate(text, source_language, dest_language)
+    if translation is None:
         return _("Error: the translation service failed")
-    return json.loads(r.content.decode("utf-8-sig"))
+    cache.set(text, source_language, dest_language, translation)
+    return translation
+
+
+def translate_batch(
+    texts: Iterable[Tuple[str, str]], dest_language: str
+) -> Dict[Tuple[str, str], Optional[str]]:
+    """Translates many texts into one language. Duplicates are translated once, cached
+    translations are looked up together, and the rest are sent to the translation service
+    concurrently over the client's connection pool.
+
+    :param texts: (text, source language) pairs to translate
+    :type texts: Iterable[Tuple[str, str]]
+    :param dest_language: Language to translate into
+    :type dest_language: str
+
+    :return: The translations keyed by (text, source language), None where translation failed
+    :rtype: Dict[Tuple[str, str], Optional[str]]
+    """
+    items: List[Tuple[str, str]] = list(dict.fromkeys(texts))
+    results: Dict[Tuple[str, str], Optional[str]] = dict.fromkeys(items)
+    results.update(cache.get_many(items, dest_language))
+    missing = [item for item, translation in results.items() if translation is None]
+    translator: Optional[TranslatorClient] = current_app.translator
+    if not missing or translator is None:
+        return results
+
+    app = current_app._get_current_object()
+
+    def call(item: Tuple[str, str]) -> Optional[str]:
+        with app.app_context():
+            return translator.translate(item[0], item[1], dest_language)
+
+    workers = min(len(missing), app.config["TRANSLATOR_POOL_SIZE"])
+    # The calls run in other threads, so they are timed here as a whole
+    with outbound_http(), ThreadPoolExecutor(max_workers=workers) as executor:
+        translations = list(executor.map(call, missing))
+    for (text, source_language), translation in zip(missing, translations):
+        results[text, source_language] = translation
+        if translation is not None:
+            cache.set(text, source_language, dest_language, translation)
+    return results
@@ -0,0 +1,232 @@
+"""
+benchmarks/followers_indexes.py
+
+Seeds a database with the pre-c4e9a17d2f05 schema (no primary key or indexes on `followers`, no
+(user_id, timestamp) index on `post`), then prints query plans and timings for the follower
+queries before and after adding them.
+
+    python benchmarks/followers_indexes.py --edges 1000000
+    python benchmarks/followers_indexes.py --database-url postgresql://localhost/microblog_bench
+
+The target database is dropped and recreated, so never point this at real data.
+"""
+import os
+import random
+import statistics
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection, Engine
+
+
+metadata = sa.MetaData()
+
+user = sa.Table(
+    "user",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("username", sa.String(64)),
+)
+
+post = sa.Table(
+    "post",
+    metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("body", sa.String(140)),
+    sa.Column("timestamp", sa.DateTime, index=True),
+    sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id")),
+)
+
+followers = sa.Table(
+    "followers",
+    metadata,
+    sa.Column("follower_id", sa.Integer, sa.ForeignKey("user.id")),
+    sa.Column("followed_id", sa.Integer, sa.ForeignKey("user.id")),
+)
+
+CHUNK_SIZE = 50000
+
+QUERIES: Dict[str, str] = {
+    "is_following": (
+        "SELECT EXISTS (SELECT 1 FROM followers "
+        "WHERE follower_id = :reader AND followed_id = :author)"
+    ),
+    "follower_count": "SELECT count(*) FROM followers WHERE followed_id = :author",
+    "following_count": "SELECT count(*) FROM followers WHERE follower_id = :reader",
+    "followed_posts": (
+        "SELECT * FROM (SELECT post.* FROM post JOIN followers "
+        "ON followers.followed_id = post.user_id WHERE followers.follower_id = :reader "
+        "UNION SELECT post.* FROM post WHERE post.user_id = :reader) AS posts "
+        "ORDER BY timestamp DESC LIMIT 10"
+    ),
+    "author_timeline": (
+        "SELECT * FROM post WHERE user_id = :author ORDER BY timestamp DESC LIMIT 10"
+    ),
+}
+
+
+def seed(connection: Connection, users: int, edges: int, posts: int) -> Tuple[int, int]:
+    """Bulk-inserts users, a power-law follow graph and posts
+
+    :return: The most followed user and a user who follows many others, for the queries to use
+    :rtype: Tuple[int, int]
+    """
+    random.seed(0)
+    connection.execute(
+        user.insert(), [{"id": i, "username": f"user{i}"} for i in range(1, users + 1)]
+    )
+
+    # Pareto-distributed popularity: a few accounts attract most of the follows
+    weights = [random.paretovariate(1.2) for _ in range(users)]
+    ids = list(range(1, users + 1))
+    seen = set()
+    batch: List[Dict[str, int]] = []
+    while len(seen) < edges:
+        follower = random.randint(1, users)
+        for followed in random.choices(ids, weights, k=64):
+            if followed != follower and (follower, followed) not in seen:
+                seen.add((follower, followed))
+                batch.append({"follower_id": follower, "followed_id": followed})
+        if len(batch) >= CHUNK_SIZE:
+            connection.execute(followers.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(followers.insert(), batch)
+
+    start = datetime.utcnow() - timedelta(days=365)
+    for offset in range(0, posts, CHUNK_SIZE):
+        connection.execute(
+            post.insert(),
+            [
+                {
+                    "body": f"post {i}",
+                    "timestamp": start + timedelta(seconds=random.randint(0, 365 * 86400)),
+                    "user_id": random.choices(ids, weights)[0],
+                }
+                for i in range(offset, min(offset + CHUNK_SIZE, posts))
+            ],
+        )
+
+    popular = connection.execute(
+        sa.text(
+            "SELECT followed_id FROM followers GROUP BY followed_id ORDER BY count(*) DESC LIMIT 1"
+        )
+    ).scalar()
+    reader = connection.execute(
+        sa.text(
+            "SELECT follower_id FROM followers GROUP BY follower_id ORDER BY count(*) DESC LIMIT 1"
+        )
+    ).scalar()
+    return popular, reader
+
+
+def add_indexes(connection: Connection) -> None:
+    """Applies the same schema changes as migration c4e9a17d2f05"""
+    connection.execute(
+        sa.text(
+            "CREATE TABLE followers_pk ("
+            "follower_id INTEGER NOT NULL, followed_id INTEGER NOT NULL, "
+            "PRIMARY KEY (follower_id, followed_id))"
+        )
+    )
+    connection.execute(
+        sa.text("INSERT INTO followers_pk SELECT DISTINCT follower_id, followed_id FROM followers")
+    )
+    connection.execute(sa.text("DROP TABLE followers"))
+    connection.execute(sa.text("ALTER TABLE followers_pk RENAME TO followers"))
+    connection.execute(
+        sa.text(
+            "CREATE INDEX ix_followers_followed_id_follower_id "
+            "ON followers (followed_id, follower_id)"
+        )
+    )
+    connection.execute(
+        sa.text("CREATE INDEX ix_post_user_id_timestamp ON post (user_id, timestamp)")
+    )
+    connection.execute(sa.text("ANALYZE"))
+
+
+def explain(connection: Connection, sql: str, params: Dict[str, int]) -> List[str]:
+    """Returns the database's plan for a query"""
+    if connection.dialect.name == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+    elif connection.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    rows = connection.execute(sa.text(prefix + sql), params).fetchall()
+    return [" ".join(str(column) for column in row) for row in rows]
+
+
+def time_query(run: Callable[[], object], repeat: int) -> float:
+    """Returns the median wall time of `repeat` runs, in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        timings.append((perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def report(engine: Engine, label: str, params: Dict[str, int], repeat: int) -> Dict[str, float]:
+    click.echo(f"\n=== {label} ===")
+    results = {}
+    with engine.connect() as connection:
+        for name, sql in QUERIES.items():
+            click.echo(f"\n-- {name}")
+            for line in explain(connection, sql, params):
+                click.echo(f"   {line}")
+            results[name] = time_query(
+                lambda: connection.execute(sa.text(sql), params).fetchall(), repeat
+            )
+            click.echo(f"   median {results[name]:.2f} ms")
+    return results
+
+
+@click.command()
+@click.option("--database-url", help="Database to (re)create, defaults to a temporary SQLite file.")
+@click.option("--users", default=20000, show_default=True)
+@click.option("--edges", default=1000000, show_default=True)
+@click.option("--posts", default=200000, show_default=True)
+@click.option("--repeat", default=5, show_default=True, help="Runs per query timing.")
+def main(database_url: str, users: int, edges: int, posts: int, repeat: int):
+    """Benchmark follower queries before and after the followers primary key and indexes."""
+    if edges > users * (users - 1):
+        raise click.BadParameter("more edges than possible pairs of users", param_hint="--edges")
+    path = None
+    if not database_url:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        database_url = f"sqlite:///{path}"
+    engine = sa.create_engine(database_url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+    click.echo(f"Seeding {users} users, {edges} follow edges and {posts} posts...")
+    start = perf_counter()
+    with engine.begin() as connection:
+        popular, reader = seed(connection, users, edges, posts)
+    click.echo(f"Seeded in {perf_counter() - start:.1f}s")
+    params = {"author": popular, "reader": reader}
+
+    before = report(engine, "before", params, repeat)
+    with engine.begin() as connection:
+        add_indexes(connection)
+    after = report(engine, "after", params, repeat)
+
+    click.echo("\n=== summary (median ms) ===")
+    click.echo(f"{'query':<18}{'before':>12}{'after':>12}{'speedup':>10}")
+    for name in QUERIES:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        click.echo(f"{name:<18}{before[name]:>12.2f}{after[name]:>12.2f}{speedup:>9.1f}x")
+
+    metadata.drop_all(engine)
+    if path:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,16 +14,102 @@ class Config:
     SECRET_KEY: str = os.environ.get("SECRET_KEY") or "you-will-never-guess"
 
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
+    # "elasticsearch", "database" (SQLite FTS5 or PostgreSQL tsvector) or "none"; by default
+    # Elasticsearch is used when ELASTICSEARCH_URL is set and the database otherwise
+    SEARCH_BACKEND: Optional[str] = os.environ.get("SEARCH_BACKEND")
+    SEARCH_TEXT_CONFIG: str = os.environ.get("SEARCH_TEXT_CONFIG") or "simple"
+    # Search index changes are queued in an outbox table and sent in bulk by a background thread,
+    # or by `flask search worker` when SEARCH_INDEXER_THREAD=0
+    SEARCH_INDEXER_THREAD: bool = os.environ.get("SEARCH_INDEXER_THREAD", "1") != "0"
+    SEARCH_QUEUE_BATCH_SIZE: int = int(os.environ.get("SEARCH_QUEUE_BATCH_SIZE") or 500)
+    SEARCH_QUEUE_POLL_INTERVAL: float = float(os.environ.get("SEARCH_QUEUE_POLL_INTERVAL") or 5)
+    SEARCH_RETRY_BASE_BACKOFF: float = float(os.environ.get("SEARCH_RETRY_BASE_BACKOFF") or 1)
+    SEARCH_RETRY_MAX_BACKOFF: float = float(os.environ.get("SEARCH_RETRY_MAX_BACKOFF") or 300)
     LANGUAGES: List[str] = ["en", "es"]
     LOG_TO_STDOUT = os.environ.get("LOG_TO_STDOUT")
     MS_TRANSLATOR_KEY = os.environ.get("MS_TRANSLATOR_KEY")
+    TRANSLATOR_URL: str = (
+        os.environ.get("TRANSLATOR_URL")
+        or "https://api.microsofttranslator.com/v2/Ajax.svc/Translate"
+    )
+    # Outbound translation calls share a pool of TRANSLATOR_POOL_SIZE connections, and fail fast
+    # for TRANSLATOR_RESET_TIMEOUT seconds after TRANSLATOR_FAILURE_THRESHOLD consecutive errors
+    TRANSLATOR_CONNECT_TIMEOUT: float = float(os.environ.get("TRANSLATOR_CONNECT_TIMEOUT") or 3.05)
+    TRANSLATOR_READ_TIMEOUT: float = float(os.environ.get("TRANSLATOR_READ_TIMEOUT") or 10)
+    TRANSLATOR_POOL_SIZE: int = int(os.environ.get("TRANSLATOR_POOL_SIZE") or 10)
+    TRANSLATOR_FAILURE_THRESHOLD: int = int(os.environ.get("TRANSLATOR_FAILURE_THRESHOLD") or 5)
+    TRANSLATOR_RESET_TIMEOUT: float = float(os.environ.get("TRANSLATOR_RESET_TIMEOUT") or 30)
+    TRANSLATE_BATCH_LIMIT: int = int(os.environ.get("TRANSLATE_BATCH_LIMIT") or 50)
+    # Post languages are detected by a background thread, memoizing up to LANGUAGE_CACHE_SIZE
+    # bodies; posts that do not fit in the queue are left for `flask language backfill`
+    LANGUAGE_CACHE_SIZE: int = int(os.environ.get("LANGUAGE_CACHE_SIZE") or 4096)
+    LANGUAGE_QUEUE_SIZE: int = int(os.environ.get("LANGUAGE_QUEUE_SIZE") or 10000)
+    LANGUAGE_BATCH_SIZE: int = int(os.environ.get("LANGUAGE_BATCH_SIZE") or 100)
+    # Translations are cached in a per-process LRU in front of the shared translation table
+    TRANSLATION_CACHE_SIZE: int = int(os.environ.get("TRANSLATION_CACHE_SIZE") or 1024)
+    TRANSLATION_CACHE_TTL: float = float(os.environ.get("TRANSLATION_CACHE_TTL") or 86400)
+    # Rendered post rows are cached in a per-process LRU, or in the backend made by this factory
+    FRAGMENT_CACHE_SIZE: int = int(os.environ.get("FRAGMENT_CACHE_SIZE") or 10000)
+    FRAGMENT_CACHE_TTL: float = float(os.environ.get("FRAGMENT_CACHE_TTL") or 86400)
+    FRAGMENT_CACHE_BACKEND: Optional[str] = os.environ.get("FRAGMENT_CACHE_BACKEND")
     POSTS_PER_PAGE: int = 10
+    # Largest page the JSON API returns for its `limit` argument
+    API_MAX_PER_PAGE: int = int(os.environ.get("API_MAX_PER_PAGE") or 100)
+
+    # Home timelines are materialized on write; authors with more followers than this limit are
+    # merged in at read time instead. Leave unset to fan out every post.
+    TIMELINE_FANOUT_LIMIT: Optional[int] = (
+        int(os.environ["TIMELINE_FANOUT_LIMIT"])
+        if os.environ.get("TIMELINE_FANOUT_LIMIT")
+        else None
+    )
+
+    # last_seen is only refreshed once older than the staleness bound, and pending values are
+    # written in bulk every FLUSH_INTERVAL seconds or once FLUSH_THRESHOLD users are waiting
+    LAST_SEEN_MAX_STALENESS: int = int(os.environ.get("LAST_SEEN_MAX_STALENESS") or 60)
+    LAST_SEEN_FLUSH_INTERVAL: int = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 60)
+    LAST_SEEN_FLUSH_THRESHOLD: int = int(os.environ.get("LAST_SEEN_FLUSH_THRESHOLD") or 100)
 
     # SQLAlchemy setup
     SQLALCHEMY_DATABASE_URI: str = os.environ.get("DATABASE_URL") or "sqlite:///" + os.path.join(
         basedir, "app.db"
     )
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
+    # Pool of each database engine, except SQLite's: a process holds up to POOL_SIZE connections
+    # plus MAX_OVERFLOW under load per engine, so size gunicorn workers against max_connections.
+    # Connections are checked before use and replaced once older than POOL_RECYCLE seconds.
+    DATABASE_POOL_SIZE: int = int(os.environ.get("DATABASE_POOL_SIZE") or 5)
+    DATABASE_MAX_OVERFLOW: int = int(os.environ.get("DATABASE_MAX_OVERFLOW") or 10)
+    DATABASE_POOL_TIMEOUT: float = float(os.environ.get("DATABASE_POOL_TIMEOUT") or 30)
+    DATABASE_POOL_RECYCLE: int = int(os.environ.get("DATABASE_POOL_RECYCLE") or 1800)
+    DATABASE_POOL_PRE_PING: bool = os.environ.get("DATABASE_POOL_PRE_PING", "1") != "0"
+    # Reads of GET requests go to one of these comma-separated replicas, except for users who
+    # wrote in the last REPLICA_STICKY_SECONDS, so that they see their own changes
+    SQLALCHEMY_REPLICA_URIS: List[str] = [
+        uri.strip()
+        for uri in (os.environ.get("DATABASE_REPLICA_URLS") or "").split(",")
+        if uri.strip()
+    ]
+    REPLICA_STICKY_SECONDS: float = float(os.environ.get("REPLICA_STICKY_SECONDS") or 5)
+
+    # In debug and testing, warn about (or with QUERY_COUNT_STRICT, fail) requests that issue more
+    # than QUERY_COUNT_LIMIT SQL statements
+    QUERY_COUNT_LIMIT: Optional[int] = (
+        int(os.environ["QUERY_COUNT_LIMIT"]) if os.environ.get("QUERY_COUNT_LIMIT") else None
+    )
+    QUERY_COUNT_STRICT: bool = os.environ.get("QUERY_COUNT_STRICT") is not None
+    # Statements slower than this many seconds are logged to logs/slow_queries.log, on Postgres
+    # with their EXPLAIN plan; ANALYZE executes slow SELECTs a second time to measure them
+    SLOW_QUERY_THRESHOLD: Optional[float] = (
+        float(os.environ["SLOW_QUERY_THRESHOLD"])
+        if os.environ.get("SLOW_QUERY_THRESHOLD")
+        else None
+    )
+    SLOW_QUERY_EXPLAIN: bool = os.environ.get("SLOW_QUERY_EXPLAIN") is not None
+    SLOW_QUERY_EXPLAIN_ANALYZE: bool = os.environ.get("SLOW_QUERY_EXPLAIN_ANALYZE") is not None
+    # Opt-in Server-Timing headers and Prometheus histograms of request, SQL and template times
+    REQUEST_METRICS: bool = os.environ.get("REQUEST_METRICS") is not None
+    METRICS_ENDPOINT: str = os.environ.get("METRICS_ENDPOINT") or "/metrics"
 
     # Mail server setup
     MAIL_SERVER: Optional[str] = os.environ.get("MAIL_SERVER")
@@ -33,3 +119,8 @@ class Config:
     MAIL_PASSWORD: Optional[str] = os.environ.get("MAIL_PASSWORD")
     MAIL_DEFAULT_SENDER: str = os.environ.get("MAIL_DEFAULT_SENDER") or f"noreply@{MAIL_SERVER}"
     ADMINS: Iterable[str] = ("stephenfeagin@example.com",)
+    # Outgoing mail is queued and sent by MAIL_WORKERS threads; once MAIL_QUEUE_SIZE messages are
+    # waiting, senders block for up to MAIL_QUEUE_TIMEOUT seconds before giving up
+    MAIL_WORKERS: int = int(os.environ.get("MAIL_WORKERS") or 2)
+    MAIL_QUEUE_SIZE: int = int(os.environ.get("MAIL_QUEUE_SIZE") or 1000)
+    MAIL_QUEUE_TIMEOUT: float = float(os.environ.get("MAIL_QUEUE_TIMEOUT") or 2)
@@ -0,0 +1,18 @@
+import os
+
+# Each worker opens up to DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW connections per database
+# engine, so keep workers times that below the database's max_connections, leaving room for
+# migrations, the search worker and other clients
+workers = int(os.environ.get("WEB_CONCURRENCY") or 1)
+# A worker's threads share its pool, so keep them at or below DATABASE_POOL_SIZE
+threads = int(os.environ.get("GUNICORN_THREADS") or 1)
+timeout = int(os.environ.get("GUNICORN_TIMEOUT") or 30)
+# Loading the app once in the master shares its memory between workers
+preload_app = os.environ.get("GUNICORN_PRELOAD") is not None
+
+
+def post_fork(server, worker):
+    """Makes a new worker open its own database connections instead of reusing the master's"""
+    from app.pool import discard_inherited_connections
+
+    discard_inherited_connections()
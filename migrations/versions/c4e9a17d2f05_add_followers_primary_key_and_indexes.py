@@ -0,0 +1,55 @@
+"""add followers primary key and indexes
+
+Revision ID: c4e9a17d2f05
+Revises: a83c2e4f7b61
+Create Date: 2026-10-17 13:40:52.117630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e9a17d2f05'
+down_revision = 'a83c2e4f7b61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Drop incomplete and duplicate follow edges so the primary key can be created
+    op.execute('DELETE FROM followers WHERE follower_id IS NULL OR followed_id IS NULL')
+    op.execute(
+        'CREATE TABLE followers_dedup AS SELECT DISTINCT follower_id, followed_id FROM followers'
+    )
+    op.execute('DELETE FROM followers')
+    op.execute(
+        'INSERT INTO followers (follower_id, followed_id) '
+        'SELECT follower_id, followed_id FROM followers_dedup'
+    )
+    op.drop_table('followers_dedup')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+    # Removing duplicates may have changed the real counts
+    op.execute(
+        'UPDATE "user" SET '
+        'follower_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
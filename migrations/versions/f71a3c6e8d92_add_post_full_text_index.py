@@ -0,0 +1,35 @@
+"""add post full text index
+
+Revision ID: f71a3c6e8d92
+Revises: e2b5d90c3a48
+Create Date: 2026-10-17 17:08:33.671245
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f71a3c6e8d92'
+down_revision = 'e2b5d90c3a48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE post_fts (id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)')
+        op.execute('CREATE INDEX ix_post_fts_document ON post_fts USING GIN (document)')
+        # Matches the default SEARCH_TEXT_CONFIG; run `flask search reindex` after changing it
+        op.execute(
+            "INSERT INTO post_fts (id, document) "
+            "SELECT id, to_tsvector('simple', coalesce(body, '')) FROM post"
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE post_fts')
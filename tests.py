@@ -1,14 +1,146 @@
+import json
+import socketserver
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-from app import create_app, db
-from app.models import Post, User
+from flask_mail import Message
+from guess_language import guess_language
+
+from app import bench, create_app, db, mail
+from app.email import (
+    dispatcher as email_dispatcher,
+    EmailQueueFull,
+    render_email,
+    send_announcement,
+    send_email,
+)
+from app.indexer import indexer as search_indexer
+from app.instrumentation import count_queries, init_request_metrics, init_slow_query_log
+from app.language import detector as language_detector
+from app.last_seen import tracker as last_seen_tracker
+from app.models import Post, SearchOutbox, User
+from app.pagination import decode_cursor, decode_sort_values, keyset_paginate
+from app.pool import (
+    apply_pool_options,
+    discard_inherited_connections,
+    pool_gauges,
+    TimedQueuePool,
+)
+from app.replicas import router as replica_router
+from app.search import DatabaseBackend, ElasticsearchBackend, PostgresBackend
+from app.translate import cache as translation_cache, CircuitBreaker, translate, TranslatorClient
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite://"
+    WTF_CSRF_ENABLED = False
+    QUERY_COUNT_LIMIT = 20
+    QUERY_COUNT_STRICT = True
+
+
+class FakeElasticsearch:
+    """Records bulk requests instead of sending them, optionally failing every request"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.requests = []
+
+    def bulk(self, body):
+        self.requests.append(body)
+        if self.fail:
+            raise ConnectionError("Elasticsearch is down")
+        return {"errors": False, "items": []}
+
+
+class StubTranslator:
+    """Local stand-in for the translation API that answers "<to>: <text>" after an optional delay,
+    counting requests and the connections they arrived on
+    """
+
+    def __init__(self):
+        self.status = 200
+        self.delay = 0
+        self.requests = self.connections = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                stub.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.delay)
+                query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                body = json.dumps(f"{query['to']}: {query['text']}").encode("utf-8-sig")
+                self.send_response(stub.status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/Translate"
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubSMTP:
+    """Minimal local SMTP server that accepts every message, counting connections. Greetings are
+    held back until `ready` is set, so tests can queue messages while the workers are connecting.
+    """
+
+    def __init__(self):
+        self.ready = Event()
+        self.connections = 0
+        self.messages = []
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stub.connections += 1
+                stub.ready.wait()
+                self.wfile.write(b"220 stub\r\n")
+                for line in self.rfile:
+                    command = line[:4].upper()
+                    if command == b"DATA":
+                        self.wfile.write(b"354 go ahead\r\n")
+                        lines = []
+                        for line in self.rfile:
+                            if line == b".\r\n":
+                                break
+                            lines.append(line)
+                        stub.messages.append(b"".join(lines))
+                    elif command == b"QUIT":
+                        self.wfile.write(b"221 bye\r\n")
+                        return
+                    self.wfile.write(b"250 ok\r\n")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.ready.set()
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class UserModelCase(unittest.TestCase):
@@ -34,6 +166,14 @@ class UserModelCase(unittest.TestCase):
         result = "https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=retro&s=128"
         self.assertEqual(u.avatar(128), result)
 
+    def test_avatars(self):
+        john = User(id=1, username="john", email="john@example.com")
+        susan = User(id=2, username="susan", email="susan@example.com")
+        avatars = User.avatars([john, susan, john], 70)
+        self.assertEqual(avatars, {1: john.avatar(70), 2: susan.avatar(70)})
+        susan.email = "susan@example.org"
+        self.assertNotEqual(susan.avatar(70), avatars[2])
+
     def test_follow(self):
         u1 = User(username="john", email="john@example.com")
         u2 = User(username="susan", email="susan@example.com")
@@ -46,6 +186,8 @@ class UserModelCase(unittest.TestCase):
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.follower_count, 1)
         self.assertEqual(u1.followed.count(), 1)
         self.assertEqual(u1.followed.first().username, "susan")
         self.assertEqual(u2.followers.count(), 1)
@@ -54,6 +196,8 @@ class UserModelCase(unittest.TestCase):
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.follower_count, 0)
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
@@ -95,6 +239,689 @@ class UserModelCase(unittest.TestCase):
         self.assertListEqual(m_followed_posts, [mary_post, david_post])
         self.assertListEqual(d_followed_posts, [david_post])
 
+    def test_timeline_unfollow_and_rebuild(self):
+        john = User(username="john", email="john@example.com")
+        susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        susan_post = Post(body="post from susan", author=susan, timestamp=now)
+        john_post = Post(body="post from john", author=john, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([susan_post, john_post])
+        db.session.commit()
+        self.assertListEqual(john.followed_posts().all(), [john_post, susan_post])
+
+        john.unfollow(susan)
+        db.session.commit()
+        self.assertListEqual(john.followed_posts().all(), [john_post])
+
+        john.follow(susan)
+        db.session.commit()
+        expected = john.followed_posts().all()
+        User.rebuild_timelines()
+        db.session.commit()
+        self.assertListEqual(john.followed_posts().all(), expected)
+        self.assertListEqual(expected, [john_post, susan_post])
+
+    def test_timeline_hybrid_fanout(self):
+        self.app.config["TIMELINE_FANOUT_LIMIT"] = 1
+        john = User(username="john", email="john@example.com")
+        susan = User(username="susan", email="susan@example.com")
+        mary = User(username="mary", email="mary@example.com")
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+        john.follow(susan)
+        mary.follow(susan)
+        db.session.commit()
+        self.assertFalse(susan.is_fanned_out())
+
+        post = Post(body="post from susan", author=susan)
+        db.session.add(post)
+        db.session.commit()
+        # susan is above the limit, so her post is only materialized in her own timeline
+        self.assertListEqual(john.followed_posts().all(), [post])
+        self.assertListEqual(mary.followed_posts().all(), [post])
+        self.assertListEqual(susan.followed_posts().all(), [post])
+
+    def test_keyset_pagination(self):
+        john = User(username="john", email="john@example.com")
+        susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        now = datetime.utcnow()
+        # posts share timestamps in pairs so that the id tiebreaker is exercised
+        posts = [
+            Post(body=f"post {i}", author=susan, timestamp=now + timedelta(seconds=i // 2))
+            for i in range(7)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        for hybrid_limit in (None, 0):
+            self.app.config["TIMELINE_FANOUT_LIMIT"] = hybrid_limit
+            for query, keys in (
+                (Post.query, None),
+                (john.followed_posts(), john.followed_posts_keys()),
+            ):
+                seen, page = [], keyset_paginate(query, 3, keys=keys)
+                pages = [page]
+                while True:
+                    seen.extend(page.items)
+                    if not page.has_next:
+                        break
+                    page = keyset_paginate(
+                        query, 3, before=decode_cursor(page.next_cursor), keys=keys
+                    )
+                    pages.append(page)
+                self.assertListEqual(seen, expected)
+                self.assertFalse(pages[0].has_prev)
+
+                # walk back up from the last page
+                back = keyset_paginate(
+                    query, 3, after=decode_cursor(pages[-1].prev_cursor), keys=keys
+                )
+                self.assertListEqual(back.items, pages[-2].items)
+
+        with self.assertRaises(ValueError):
+            decode_cursor("not-a-cursor")
+
+    def test_last_seen_batched_flush(self):
+        self.app.config["LAST_SEEN_FLUSH_THRESHOLD"] = 2
+        long_ago = datetime.utcnow() - timedelta(days=1)
+        john = User(username="john", email="john@example.com", last_seen=long_ago)
+        susan = User(username="susan", email="susan@example.com", last_seen=long_ago)
+        mary = User(username="mary", email="mary@example.com", last_seen=datetime.utcnow())
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+
+        # mary was seen within the staleness bound, so she is not recorded at all
+        last_seen_tracker.record(mary)
+        last_seen_tracker.record(john)
+        db.session.expire_all()
+        self.assertEqual(john.last_seen, long_ago)
+
+        # the second pending user reaches the threshold and both are written at once
+        last_seen_tracker.record(susan)
+        db.session.expire_all()
+        self.assertGreater(john.last_seen, long_ago)
+        self.assertGreater(susan.last_seen, long_ago)
+        self.assertEqual(last_seen_tracker.flush(), 0)
+
+    def test_reconcile_follow_counts(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(User.reconcile_follow_counts(), 0)
+
+        u2.follower_count = 5
+        db.session.commit()
+        self.assertEqual(User.reconcile_follow_counts(), 1)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u1.following_count, 1)
+
+    def test_search_outbox(self):
+        self.app.elasticsearch = FakeElasticsearch(fail=True)
+        self.app.search_backend = ElasticsearchBackend()
+        john = User(username="john", email="john@example.com")
+        post = Post(body="first draft", author=john)
+        db.session.add_all([john, post])
+        db.session.commit()
+        post.body = "second draft"
+        db.session.commit()
+        self.assertEqual(SearchOutbox.query.count(), 2)
+
+        # a failed bulk request leaves the entries queued with a backoff
+        self.assertEqual(search_indexer.drain(), 2)
+        self.assertEqual(SearchOutbox.query.filter_by(attempts=1).count(), 2)
+        self.assertEqual(search_indexer.drain(), 0)
+
+        # once due again, both entries collapse into one index action with the current body
+        SearchOutbox.query.update({"available_at": datetime.utcnow()})
+        self.app.elasticsearch = FakeElasticsearch()
+        self.assertEqual(search_indexer.drain(), 2)
+        self.assertListEqual(
+            self.app.elasticsearch.requests,
+            [
+                [
+                    {"index": {"_index": "post", "_id": post.id}},
+                    {"body": "second draft", "id": post.id},
+                ]
+            ],
+        )
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+        post_id = post.id
+        db.session.delete(post)
+        db.session.commit()
+        search_indexer.drain()
+        self.assertEqual(
+            self.app.elasticsearch.requests[-1], [{"delete": {"_index": "post", "_id": post_id}}]
+        )
+
+    def test_streaming_reindex(self):
+        john = User(username="john", email="john@example.com")
+        db.session.add_all([john] + [Post(body=f"post {i}", author=john) for i in range(5)])
+        db.session.commit()
+        self.app.elasticsearch = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend()
+        progress = []
+        sent, failed = Post.reindex(
+            chunk_size=2, workers=2, progress=lambda sent, elapsed: progress.append(sent)
+        )
+        self.assertEqual((sent, failed), (5, 0))
+        self.assertEqual(len(self.app.elasticsearch.requests), 3)
+        self.assertEqual(progress[-1], 5)
+
+    def test_database_search(self):
+        john = User(username="john", email="john@example.com")
+        first = Post(body="the quick brown fox", author=john)
+        second = Post(body="a quick reply", author=john)
+        db.session.add_all([john, first, second])
+        db.session.commit()
+
+        posts = Post.search("quick", 10)
+        self.assertSetEqual(set(posts.items), {first, second})
+        self.assertFalse(posts.has_next or posts.has_prev)
+        self.assertListEqual(Post.search('fox "', 10).items, [first])
+
+        first.body = "the lazy dog"
+        db.session.delete(second)
+        db.session.commit()
+        self.assertListEqual(Post.search("quick", 10).items, [])
+        self.assertEqual(Post.reindex(), (1, 0))
+        self.assertListEqual(Post.search("lazy", 10).items, [first])
+
+    def test_search_after_pagination(self):
+        john = User(username="john", email="john@example.com")
+        posts = [Post(body=f"searchable post {i}", author=john) for i in range(5)]
+        db.session.add_all([john] + posts)
+        db.session.commit()
+
+        pages = [Post.search("searchable", 2)]
+        while pages[-1].has_next:
+            pages.append(
+                Post.search("searchable", 2, before=decode_sort_values(pages[-1].next_cursor))
+            )
+        self.assertListEqual([len(page.items) for page in pages], [2, 2, 1])
+        self.assertSetEqual({post for page in pages for post in page.items}, set(posts))
+        self.assertTrue(pages[-1].has_prev)
+
+        back = Post.search("searchable", 2, after=decode_sort_values(pages[-1].prev_cursor))
+        self.assertListEqual(back.items, pages[1].items)
+        self.assertTrue(back.has_next and back.has_prev)
+
+        # one query for the hits, and one for the posts with their authors
+        with count_queries() as counter:
+            [post.author.username for post in Post.search("searchable", 10).items]
+        self.assertEqual(counter.count, 2)
+
+    def test_seek_over_tied_ranks(self):
+        def page(search_after, ascending=False):
+            condition, order_by = DatabaseBackend.seek("rank", "id", search_after, ascending)
+            score, id = search_after or (None, None)
+            rows = db.session.execute(
+                db.text(
+                    "WITH hits(id, rank) AS (VALUES (1, 0.0607927), (2, 0.0607927), "
+                    "(3, 0.0607927), (4, 0.0607927), (5, 0.5)) "
+                    f"SELECT id, rank FROM hits WHERE true {condition}{order_by} LIMIT 2"
+                ),
+                {"score": score, "id": id},
+            ).fetchall()
+            return [id for id, _ in rows], [list(row) for row in rows]
+
+        pages = [page(None)]
+        while pages[-1][0]:
+            pages.append(page(pages[-1][1][-1]))
+        self.assertListEqual([ids for ids, _ in pages], [[5, 4], [3, 2], [1], []])
+        # Walking back from the first hit of a page returns the tied rows just before it
+        back, _ = page(pages[2][1][0], ascending=True)
+        self.assertListEqual(back, [2, 3])
+
+        # Postgres ranks are compared as the same double precision value the cursor carries
+        with mock.patch.object(db.session, "execute", return_value=[]) as execute:
+            PostgresBackend().query_index("post", "quick", 10, [0.0607927, 3])
+        statement = str(execute.call_args[0][0])
+        self.assertIn("CAST(ts_rank(document, q) AS double precision) AS rank", statement)
+        self.assertIn("(rank, id) < (:score, :id)", statement)
+
+    def test_bench(self):
+        seeded = bench.seed(users=30, edges=200, posts=100)
+        self.assertEqual((seeded["users"], seeded["edges"]), (30, 200))
+        popular = User.query.filter_by(username=seeded["popular"]).first()
+        self.assertEqual(popular.follower_count, popular.followers.count())
+
+        results = bench.run(["explore", "search"], 12, concurrency=2, warmup=1)
+        # writes from several threads would share the in-memory database's single connection
+        results.update(bench.run(["follow"], 12, concurrency=1, warmup=1))
+        for name, result in results.items():
+            self.assertEqual((result["requests"], result["errors"]), (12, 0), name)
+            latency = result["latency_ms"]
+            self.assertLessEqual(latency["p50"], latency["p95"])
+            self.assertLessEqual(latency["p95"], latency["p99"])
+            self.assertGreater(result["queries_per_request"], 0)
+        self.assertEqual(bench.percentile([4, 1, 3, 2], 50), 2)
+
+    def test_translation_cache(self):
+        stub = StubTranslator()
+        self.addCleanup(stub.close)
+        self.app.translator = TranslatorClient(stub.url, "key")
+        with self.app.test_request_context():
+            self.assertEqual(translate("hello world", "en", "es"), "es: hello world")
+            self.assertEqual(translate("hello world", "en", "es"), "es: hello world")
+            self.assertEqual(stub.requests, 1)
+
+            # a fresh process finds it in the translation table
+            self.app.extensions["translation_cache"].memory.clear()
+            self.assertEqual(translate("hello world", "en", "es"), "es: hello world")
+            self.assertEqual(stub.requests, 1)
+
+            stub.status = 500
+            self.assertEqual(
+                translate("hello world", "en", "fr"), "Error: the translation service failed"
+            )
+            self.assertEqual(stub.requests, 2)
+        self.assertEqual(
+            translation_cache.stats(),
+            {"memory_size": 1, "memory_hits": 0, "persistent_hits": 1, "misses": 2},
+        )
+
+    def test_translator_client(self):
+        stub = StubTranslator()
+        self.addCleanup(stub.close)
+        client = TranslatorClient(
+            stub.url, "key", timeout=(1, 0.2), pool_size=4, breaker=CircuitBreaker(3, 0.5)
+        )
+        self.addCleanup(client.close)
+
+        # concurrent calls share a small pool of kept-alive connections
+        texts = [f"post {i}" for i in range(40)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda text: client.translate(text, "en", "es"), texts))
+        self.assertListEqual(results, [f"es: {text}" for text in texts])
+        self.assertLessEqual(stub.connections, 4)
+
+        # a slow service is cut off by the read timeout, then the circuit opens
+        stub.delay = 0.5
+        start = time.perf_counter()
+        for _ in range(5):
+            self.assertIsNone(client.translate("hello", "en", "es"))
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertTrue(client.breaker.is_open)
+        self.assertEqual(stub.requests, 43)
+
+        # once the reset timeout has passed, a successful trial call closes it again
+        stub.delay = 0
+        time.sleep(0.5)
+        self.assertEqual(client.translate("hello", "en", "es"), "es: hello")
+        self.assertFalse(client.breaker.is_open)
+
+    def test_email_dispatcher(self):
+        stub = StubSMTP()
+        self.addCleanup(stub.close)
+        state = self.app.extensions["mail"]
+        state.suppress, state.server, state.port = False, "127.0.0.1", stub.port
+        self.app.config.update(MAIL_WORKERS=2, MAIL_QUEUE_SIZE=5)
+        email_dispatcher.init_app(self.app)
+
+        # two messages are taken by the connecting workers and five wait in the queue
+        for i in range(7):
+            send_email(f"message {i}", sender="admin@example.com", recipients=["a@example.com"])
+        with self.assertRaises(EmailQueueFull):
+            email_dispatcher.send(Message("overflow", recipients=["a@example.com"]), timeout=0.1)
+
+        stub.ready.set()
+        email_dispatcher.join()
+        self.assertEqual(len(stub.messages), 7)
+        # each worker sent everything it found queued over its one connection
+        self.assertEqual(stub.connections, 2)
+
+    def test_announcement_renders_once_per_locale(self):
+        locales = ["en", "es", None, "es", "en"]
+        db.session.add_all(
+            [
+                User(username=f"user{i}", email=f"user{i}@example.com", locale=locale)
+                for i, locale in enumerate(locales)
+            ]
+        )
+        db.session.commit()
+
+        with mock.patch("app.email.render_email", wraps=render_email) as render, \
+                mail.record_messages() as outbox:
+            queued = send_announcement("News", "announcement", chunk_size=2, message="Hello")
+            email_dispatcher.join()
+        self.assertEqual(queued, 5)
+        self.assertEqual(render.call_count, 2)
+        self.assertListEqual(
+            sorted(recipient for msg in outbox for recipient in msg.recipients),
+            [f"user{i}@example.com" for i in range(5)],
+        )
+        self.assertIn("Hello", outbox[0].body)
+
+    def test_language_backfill_and_memo(self):
+        john = User(username="john", email="john@example.com")
+        spanish = "Hola a todos, este es un mensaje escrito en español para la prueba"
+        posts = [
+            Post(body=spanish, author=john),
+            Post(body=spanish, author=john, language=""),
+            Post(body="This message was written in English for the test", author=john),
+            Post(body="Ceci est un message en français", author=john, language="fr"),
+        ]
+        db.session.add_all([john] + posts)
+        db.session.commit()
+
+        with mock.patch("app.language.guess_language", wraps=guess_language) as guess:
+            self.assertEqual(language_detector.backfill(batch_size=1), 2)
+            self.assertEqual(language_detector.backfill(include_unknown=True), 1)
+        # identical bodies are only analysed once
+        self.assertEqual(guess.call_count, 2)
+        db.session.expire_all()
+        self.assertListEqual([post.language for post in posts], ["es", "es", "en", "fr"])
+
+    def test_connection_pool(self):
+        # SQLite keeps the pool Flask-SQLAlchemy picks for it
+        self.assertNotIsInstance(db.engine.pool, TimedQueuePool)
+        options = {}
+        apply_pool_options(self.app, options)
+        self.assertIs(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_recycle"], 1800)
+
+        options.update(pool_size=1, max_overflow=0)
+        engine = db.create_engine("sqlite://", options)
+        waits = []
+        engine.pool.observe = waits.append
+        with engine.connect():
+            gauges = pool_gauges({"primary": engine})
+        self.assertEqual(gauges['microblog_db_pool_checked_out{database="primary"}'], 1)
+        self.assertEqual(gauges['microblog_db_pool_overflow{database="primary"}'], 0)
+        self.assertEqual(len(waits), 1)
+
+        inherited = engine.pool
+        with mock.patch("app.pool._engines", {engine}), mock.patch("app.pool._inherited_pools", []):
+            discard_inherited_connections()
+        self.assertIsNot(engine.pool, inherited)
+        self.assertEqual(engine.pool.observe, waits.append)
+        self.assertEqual(inherited.checkedin(), 1)
+
+
+class RouteCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        john = User(username="john", email="john@example.com")
+        john.set_password("cat")
+        authors = [User(username=f"author{i}", email=f"author{i}@example.com") for i in range(5)]
+        db.session.add_all([john] + authors)
+        db.session.commit()
+        now = datetime.utcnow()
+        for i in range(20):
+            author = authors[i % len(authors)]
+            john.follow(author)
+            db.session.add(
+                Post(body=f"post {i}", author=author, timestamp=now + timedelta(seconds=i))
+            )
+        db.session.commit()
+        self.client.post("/auth/login", data={"username": "john", "password": "cat"})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_listing_query_count_is_constant(self):
+        for path in ("/index", "/explore", "/user/author0"):
+            counts = []
+            for per_page in (2, 10):
+                self.app.config["POSTS_PER_PAGE"] = per_page
+                with count_queries() as counter:
+                    response = self.client.get(path)
+                self.assertEqual(response.status_code, 200)
+                counts.append(counter.count)
+            self.assertEqual(counts[0], counts[1], path)
+
+    def test_user_popup_is_a_single_query(self):
+        response = self.client.get("/user/author0/popup")
+        self.assertEqual(response.status_code, 200)
+        with count_queries() as counter:
+            response = self.client.get("/user/author0/popup")
+        self.assertIn("1 followers", response.get_data(as_text=True))
+        # one query to load the logged-in user, one for the popup itself
+        self.assertEqual(counter.count, 2)
+
+    def test_batch_translation(self):
+        stub = StubTranslator()
+        self.addCleanup(stub.close)
+        self.app.translator = TranslatorClient(stub.url, "key")
+        posts = Post.query.order_by(Post.id).limit(4).all()
+        for post in posts:
+            post.language = "es"
+        posts[1].body = posts[0].body
+        posts[3].language = ""
+        db.session.commit()
+        ids = [post.id for post in posts]
+
+        response = self.client.post(
+            "/translate/batch", json={"ids": ids + ids[:1], "dest_language": "en"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(
+            response.get_json()["translations"],
+            {str(post.id): f"en: {post.body}" for post in posts[:3]},
+        )
+        # the shared body is only translated once, and cached translations are reused
+        self.assertEqual(stub.requests, 2)
+        self.client.post("/translate/batch", json={"ids": ids, "dest_language": "en"})
+        self.assertEqual(stub.requests, 2)
+
+        response = self.client.post("/translate/batch", json={"ids": ids, "dest_language": "xx"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_password_reset_email_is_queued(self):
+        self.client.get("/auth/logout")
+        with mail.record_messages() as outbox:
+            response = self.client.post(
+                "/auth/reset_password_request",
+                data={"email": "john@example.com"},
+                headers={"Accept-Language": "es"},
+            )
+            email_dispatcher.join()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(outbox), 1)
+        self.assertListEqual(outbox[0].recipients, ["john@example.com"])
+        # rendered by the dispatcher in the requester's locale
+        self.assertEqual(outbox[0].subject, "[Microblog] Nueva Contraseña")
+        self.assertIn("http://localhost/auth/reset_password/", outbox[0].body)
+
+    def test_language_is_detected_after_commit(self):
+        body = "Hola a todos, este es un mensaje escrito en español para la prueba"
+        response = self.client.post("/index", data={"post": body})
+        self.assertEqual(response.status_code, 302)
+        post = Post.query.filter_by(body=body).one()
+        self.assertIsNone(post.language)
+
+        self.assertEqual(language_detector.drain(), 1)
+        db.session.expire_all()
+        self.assertEqual(post.language, "es")
+
+    def test_post_rows_are_cached_until_the_author_is_renamed(self):
+        fragments = self.app.extensions["fragment_cache"]
+        self.client.get("/explore")
+        rows = len(fragments)
+        self.assertEqual(rows, self.app.config["POSTS_PER_PAGE"])
+        self.client.get("/explore")
+        self.assertEqual(fragments.hits, rows)
+
+        author = User.query.filter_by(username="author0").first()
+        author.set_password("dog")
+        db.session.commit()
+        self.client.get("/auth/logout")
+        self.client.post("/auth/login", data={"username": "author0", "password": "dog"})
+        self.client.post("/edit_profile", data={"username": "renamed", "about_me": ""})
+        html = self.client.get("/explore").get_data(as_text=True)
+        self.assertIn("renamed", html)
+        self.assertNotIn("author0", html)
+
+    def test_conditional_get(self):
+        for path in ("/explore", "/user/author0", "/user/author0/popup"):
+            response = self.client.get(path)
+            etag = response.headers["ETag"]
+            self.assertTrue(response.cache_control.private)
+            with count_queries() as counter:
+                response = self.client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304, path)
+            self.assertEqual(response.headers["ETag"], etag)
+            self.assertLessEqual(counter.count, 3, path)
+
+        response = self.client.get("/user/author0/popup")
+        etag = response.headers["ETag"]
+        self.client.get("/unfollow/author0")
+        response = self.client.get("/user/author0/popup", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", self.client.get("/explore").headers)  # renders the pending flash
+
+        etag = self.client.get("/explore").headers["ETag"]
+        author = User.query.filter_by(username="author0").first()
+        timestamp = datetime.utcnow() + timedelta(minutes=1)
+        db.session.add(Post(body="new post", author=author, timestamp=timestamp))
+        db.session.commit()
+        response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("new post", response.get_data(as_text=True))
+
+    def test_api(self):
+        self.app.config["POSTS_PER_PAGE"] = 8
+        ids = []
+        url = "/api/v1/timeline"
+        while url:
+            data = self.client.get(url).get_json()
+            ids += [post["id"] for post in data["items"]]
+            url = data["next"]
+        self.assertEqual(len(ids), 20)
+        self.assertListEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(data["items"][-1]["author"]["username"], "author0")
+
+        data = self.client.get("/api/v1/explore?limit=3").get_json()
+        self.assertListEqual([post["id"] for post in data["items"]], ids[:3])
+        data = self.client.get(data["next"]).get_json()
+        self.assertListEqual([post["id"] for post in data["items"]], ids[3:6])
+        data = self.client.get(data["prev"]).get_json()
+        self.assertListEqual([post["id"] for post in data["items"]], ids[:3])
+
+        data = self.client.get("/api/v1/users/author0").get_json()
+        self.assertEqual(data["follower_count"], 1)
+        self.assertTrue(data["is_following"])
+        data = self.client.get("/api/v1/users/author0/posts").get_json()
+        self.assertEqual(len(data["items"]), 4)
+        data = self.client.get("/api/v1/users/author0/followers").get_json()
+        self.assertListEqual([user["username"] for user in data["items"]], ["john"])
+        data = self.client.get("/api/v1/search?q=post&limit=15").get_json()
+        self.assertEqual(len(data["items"]), 15)
+        self.assertIsNotNone(data["next"])
+
+        response = self.client.get("/api/v1/users/nobody")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()["error"], "Not Found")
+        self.client.get("/auth/logout")
+        self.assertEqual(self.client.get("/api/v1/timeline").status_code, 401)
+
+    def test_request_metrics(self):
+        self.app.config["REQUEST_METRICS"] = True
+        init_request_metrics(self.app)
+        response = self.client.get("/explore")
+        server_timing = response.headers["Server-Timing"]
+        names = {metric.split(";")[0].strip() for metric in server_timing.split(",")}
+        self.assertSetEqual(names, {"db", "tpl", "http", "total"})
+        self.assertNotIn("tpl;dur=0.0,", server_timing)
+
+        metrics = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'microblog_request_duration_seconds_count{endpoint="main.explore",method="GET"} 1',
+            metrics,
+        )
+        self.assertIn(
+            'microblog_request_queries_bucket{endpoint="main.explore",le="+Inf"} 1', metrics
+        )
+        self.assertIn("microblog_translation_cache_misses 0", metrics)
+        self.assertIn("microblog_fragment_cache_size 10", metrics)
+        self.assertIn("# TYPE microblog_db_pool_wait_seconds histogram", metrics)
+
+    def test_slow_query_log(self):
+        self.app.config["SLOW_QUERY_THRESHOLD"] = 0
+        init_slow_query_log(self.app)
+        with self.assertLogs("microblog.slow_queries", "WARNING") as logs:
+            self.client.get("/user/author0/popup")
+        self.assertIn("GET /user/author0/popup (main.user_popup)", logs.output[-1])
+        self.assertIn("parameters:", logs.output[-1])
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{self.directory.name}/primary.db"
+            SQLALCHEMY_REPLICA_URIS = [f"sqlite:///{self.directory.name}/replica.db"]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        (self.replica,) = replica_router.engines(self.app)
+        db.Model.metadata.create_all(self.replica)
+        self.client = self.app.test_client()
+
+        john = User(username="john", email="john@example.com")
+        john.set_password("cat")
+        db.session.add_all([john, User(username="susan", email="susan@example.com")])
+        db.session.commit()
+        # The replica lags behind: only john has been replicated
+        with self.replica.begin() as connection:
+            connection.execute(
+                User.__table__.insert(),
+                {
+                    "id": john.id,
+                    "username": "john",
+                    "email": "john@example.com",
+                    "password_hash": john.password_hash,
+                },
+            )
+        self.client.post("/auth/login", data={"username": "john", "password": "cat"})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def test_reads_are_routed_to_the_replica_until_the_user_writes(self):
+        # Logging in stored john's locale, so his reads stick to the primary for a while
+        self.assertEqual(self.client.get("/user/susan").status_code, 200)
+
+        now = time.time()
+        with mock.patch("app.replicas.time", return_value=now + 60):
+            self.assertEqual(self.client.get("/user/john").status_code, 200)
+            self.assertEqual(self.client.get("/user/susan").status_code, 404)
+            # follow reads from the primary, and its write makes the next reads stick to it again
+            self.client.get("/follow/susan")
+            self.assertEqual(self.client.get("/user/susan").status_code, 200)
+        self.assertEqual(User.query.filter_by(username="susan").first().follower_count, 1)
+
+        with mock.patch("app.replicas.time", return_value=now + 120):
+            self.assertEqual(self.client.get("/user/susan").status_code, 404)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)